@@ -0,0 +1,180 @@
+'''
+benchmarks for the data pipeline, loss and inference hot paths on synthetic arrivals
+
+    python bench.py --nentities 1000 10000 --nseq 100 --neventtypes 4 --out bench.jsonl
+
+writes one json line per (benchmark, size) with best wall time, latency per call,
+throughput in cells (entity x timestep x event type) per second and peak traced memory
+benchmarks needing keras are skipped if it cannot be imported
+'''
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tracemalloc
+
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'data'))
+
+import utils
+import matrnn_distributional as dist
+import TimeSeriesTransforms as tstf
+import eventlog
+
+
+def synthetic(nent, nseq, nev, rate=.1, seed=0):
+    '''
+    indicators of shape (nent, nseq, nev) and the same arrivals as a long table
+    entities start at random times, earlier periods are padding
+    '''
+    rng = np.random.RandomState(seed)
+    indicators = rng.rand(nent, nseq, nev) < rate
+    startat = rng.randint(0, nseq // 2 + 1, size=nent)
+    indicators[np.arange(nseq)[None, :] < startat[:, None]] = False
+    entity, time, eventtype = np.nonzero(indicators)
+    return indicators, startat, (entity, time, eventtype)
+
+
+def getsingle_loop(indicators, startat):
+    '''per entity and event type loop as in get_single of the data notebooks'''
+    nent, nseq, nev = indicators.shape
+    out = np.empty((nent, nseq, nev, 4))
+    out[:] = -1
+    for i in range(nent):
+        for k in range(nev):
+            ind = indicators[i, startat[i]:, k]
+            out[i, startat[i]:, k, 0] = tstf.tse(ind)
+            out[i, startat[i]:, k, 1] = tstf.tte(ind)
+    return out
+
+
+def splitinput(y, ncov=8, seed=0):
+    '''m in the layout of mlocaltrain, (tse, tte, unc, pcs) of first event type then covariates'''
+    rng = np.random.RandomState(seed)
+    nent, nseq = y.shape[:2]
+    m = np.concatenate([y[:, :, 0, :], rng.uniform(-1, 1, (nent, nseq, ncov))], axis=-1)
+    m[:, :, 4:][y[:, :, 0, 0] == -1] = -1
+    return m
+
+
+def measure(fn, repeat):
+    '''best wall time over repeat runs, then peak traced memory of one more run'''
+    times = []
+    for r in range(repeat):
+        t0 = time.time()
+        fn()
+        times.append(time.time() - t0)
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return min(times), peak
+
+
+def benchmarks(nent, nseq, nev, winlen, loopmax):
+    '''
+    yield (name, fn, ncalls, ncells) for one problem size
+    loop baselines run on at most loopmax entities and are reported per cell
+    '''
+    indicators, startat, (entity, t, eventtype) = synthetic(nent, nseq, nev)
+    nloop = min(nent, loopmax)
+
+    yield ('tstf.tse+tte loop', lambda: [(tstf.tse(indicators[i, :, k]), tstf.tte(indicators[i, :, k]))
+                                         for i in range(nloop) for k in range(nev)],
+           nloop*nev, nloop*nseq*nev)
+    yield ('tstf.transform_nd', lambda: tstf.transform_nd(indicators, axis=1), 1, nent*nseq*nev)
+
+    yield ('get_single loop', lambda: getsingle_loop(indicators[:nloop], startat[:nloop]), nloop, nloop*nseq*nev)
+    yield ('eventlog.densify', lambda: eventlog.densify(entity, t, eventtype, end=nseq-1, start=startat, nseq=nseq),
+           1, nent*nseq*nev)
+
+    y, _, _ = eventlog.densify(entity, t, eventtype, end=nseq-1, start=startat, nseq=nseq)
+    x, ysplit = utils.split(splitinput(y))
+    nwin = len(utils.windowindex(x, winlen)[0])
+    yield ('utils.getlongver', lambda: utils.getlongver(x, ysplit, winlen), 1, nwin*winlen)
+
+    rng = np.random.RandomState(0)
+    elapsed = np.maximum(y[:, -1, :, 0], 0)
+    sc, sh = rng.uniform(1, 50, elapsed.shape), rng.uniform(.5, 5, elapsed.shape)
+    horizon = 28
+    yield ('dist.logsurv', lambda: dist.logsurv(elapsed, 7, sc, sh), 1, nent*nev)
+    yield ('dist.quantile', lambda: dist.quantile(elapsed, .5, sc, sh), 1, nent*nev)
+    yield ('dist.logdiscrete horizon loop', lambda: [dist.logdiscrete(elapsed, j, sc, sh) for j in range(horizon)],
+           horizon, nent*nev*horizon)
+    yield ('dist.discretegrid', lambda: dist.discretegrid(elapsed, sc, sh, horizon), 1, nent*nev*horizon)
+
+    for item in kerasbenchmarks(x, ysplit, y, nent, nseq, nev, winlen):
+        yield item
+
+
+def kerasbenchmarks(x, ysplit, y, nent, nseq, nev, winlen):
+    '''loss forward/backward and MATRNN.infer, skipped without keras'''
+    try:
+        import tempfile
+        import keras.backend as K
+        import matrnn_objective as obj
+        import matrnn_fitter as fitter
+    except ImportError as e:
+        print ('skipping keras benchmarks:', e)
+        return
+
+    ytrue = np.where(y < 0, 0, y).astype(K.floatx())
+    rng = np.random.RandomState(0)
+    ypred = np.stack([rng.uniform(1, 50, y.shape[:-1]), rng.uniform(.5, 5, y.shape[:-1])], axis=-1).astype(K.floatx())
+    for fused in [False, True]:
+        ytrue_ph, ypred_ph = K.placeholder(shape=ytrue.shape), K.placeholder(shape=ypred.shape)
+        loss = K.mean(obj.ExcessConditionalLoss(fused=fused).loss(ytrue_ph, ypred_ph))
+        fwd = K.function([ytrue_ph, ypred_ph], [loss])
+        bwd = K.function([ytrue_ph, ypred_ph], K.gradients(loss, [ypred_ph]))
+        name = 'ExcessConditionalLoss' + (' fused' if fused else '')
+        yield (name + ' forward', lambda: fwd([ytrue, ypred]), 1, nent*nseq*nev)
+        yield (name + ' backward', lambda: bwd([ytrue, ypred]), 1, nent*nseq*nev)
+
+    model = fitter.MATRNN(modelspec_tuple=(2, 16), jobid='bench')
+    model.weightsfname = os.path.join(tempfile.mkdtemp(), model.weightsfname)
+    model.compile(nvar=x.shape[2], nseq=winlen, iniscale=10., verbose=0)
+    model.kmodel.save_weights(model.weightsfname)
+    xtest = x[:, -winlen:, :]
+    yield ('MATRNN.infer', lambda: model.infer(xtest, verbose=0), 1, nent*winlen)
+    yield ('MATRNN.infer laststep', lambda: model.infer(xtest, verbose=0, laststep=True), 1, nent*winlen)
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--nentities', type=int, nargs='+', default=[1000])
+    parser.add_argument('--nseq', type=int, nargs='+', default=[100])
+    parser.add_argument('--neventtypes', type=int, nargs='+', default=[4])
+    parser.add_argument('--winlen', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--loopmax', type=int, default=200, help='max entities for python loop baselines')
+    parser.add_argument('--only', default=None, help='run benchmarks whose name contains this')
+    parser.add_argument('--out', default=None, help='append json lines here as well as stdout')
+    args = parser.parse_args(args)
+
+    out = open(args.out, 'a') if args.out is not None else None
+    for nent in args.nentities:
+        for nseq in args.nseq:
+            for nev in args.neventtypes:
+                for name, fn, ncalls, ncells in benchmarks(nent, nseq, nev, args.winlen, args.loopmax):
+                    if args.only is not None and args.only not in name:
+                        continue
+                    seconds, peak = measure(fn, args.repeat)
+                    res = {'name': name, 'nentities': nent, 'nseq': nseq, 'neventtypes': nev,
+                           'seconds': seconds, 'latency': seconds / ncalls,
+                           'cellspersec': ncells / seconds if seconds > 0 else float('inf'),
+                           'peakbytes': peak, 'numpy': np.__version__, 'machine': platform.machine(),
+                           'time': time.strftime('%Y-%m-%dT%H:%M:%S')}
+                    line = json.dumps(res)
+                    print (line)
+                    if out is not None:
+                        out.write(line + '\n')
+                        out.flush()
+    if out is not None:
+        out.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,11 @@
 import numpy as np
 
-def tse(indicators):
+def tse(indicators, dtype=float):
     '''
     return time since event, given vector of indicators
     '''
     ndat = len(indicators)
-    tse = np.zeros(ndat)
+    tse = np.zeros(ndat, dtype=dtype)
     accum_tse = 0
     for tdex in range(ndat):
         if indicators[tdex] == 0:
@@ -16,12 +16,12 @@ def tse(indicators):
     return tse
 
 
-def tte(indicators):
+def tte(indicators, dtype=float):
     '''
     return time to event, given vector of indicators
     '''
     ndat = len(indicators)
-    tte = np.zeros(ndat)
+    tte = np.zeros(ndat, dtype=dtype)
     accum_tte = 0
     for tdex in range(ndat - 1, 0, -1):
         if indicators[tdex] == 0:
@@ -29,4 +29,77 @@ def tte(indicators):
         else:
             accum_tte = 0
         tte[tdex - 1] = accum_tte
-    return tte
\ No newline at end of file
+    return tte
+
+def _lastevent(indicators, axis):
+    '''index of latest event at or before t along axis, -1 if none yet'''
+    ind = np.moveaxis(np.asarray(indicators), axis, -1)
+    tdex = np.arange(ind.shape[-1])
+    last = np.where(ind != 0, tdex, -1)
+    np.maximum.accumulate(last, axis=-1, out=last)
+    return last, tdex
+
+
+def _nextevent(indicators, axis):
+    '''index of earliest event after t along axis, ndat if none'''
+    ind = np.moveaxis(np.asarray(indicators), axis, -1)
+    ndat = ind.shape[-1]
+    tdex = np.arange(ndat)
+    nxt = np.full(ind.shape, ndat, dtype=tdex.dtype)
+    # reverse cumulative min of event indices, shifted by one step
+    nxt[..., :-1] = np.where(ind[..., 1:] != 0, tdex[1:], ndat)
+    nxt = np.minimum.accumulate(nxt[..., ::-1], axis=-1)[..., ::-1]
+    return nxt, tdex
+
+
+def tse_nd(indicators, axis=-1, dtype=float):
+    '''return time since event along axis, same as tse for each vector'''
+    last, tdex = _lastevent(indicators, axis)
+    return np.moveaxis((tdex - last).astype(dtype), -1, axis)
+
+
+def tte_nd(indicators, axis=-1, dtype=float):
+    '''return time to event along axis, same as tte for each vector'''
+    nxt, tdex = _nextevent(indicators, axis)
+    return np.moveaxis((nxt - tdex - 1).astype(dtype), -1, axis)
+
+
+def unc_nd(indicators, axis=-1, dtype=float):
+    '''return 1 where next event is observed before end of indicators along axis'''
+    nxt, tdex = _nextevent(indicators, axis)
+    return np.moveaxis((nxt < tdex.shape[0]).astype(dtype), -1, axis)
+
+
+def purchstatus_nd(indicators, axis=-1, dtype=float):
+    '''return 1 where first event has occurred along axis'''
+    last, tdex = _lastevent(indicators, axis)
+    return np.moveaxis((last > -1).astype(dtype), -1, axis)
+
+
+def transform_nd(indicators, axis=-1, out=None, dtype=float, before=None):
+    '''
+    return (tse, tte, unc, purchstatus) stacked in a new last axis
+    e.g. indicators.shape = (nobs, nseq, nevents) with axis=1
+        gives shape (nobs, nseq, nevents, 4)
+    out can be a preallocated array of that shape to be written into
+    dtype of a new out, integers such as np.int16 store all four exactly in less memory
+    before, for indicators that are a window of a longer series, is the shape of indicators without axis
+        with the number of steps from the latest event before the window to its first step, 0 if none
+        so tse and purchstatus carry on from it
+    '''
+    last, tdex = _lastevent(indicators, axis)
+    seen = last > -1
+    if before is not None:
+        before = np.asarray(before)[..., None]
+        last = np.where(~seen & (before > 0), -before, last)
+        seen |= before > 0
+    nxt, _ = _nextevent(indicators, axis)
+    if out is None:
+        out = np.empty(np.shape(indicators) + (4,), dtype=dtype)
+    # view of out with time axis second last, same layout as last and nxt
+    work = np.moveaxis(out, axis - 1 if axis < 0 else axis, -2)
+    work[..., 0] = tdex - last
+    work[..., 1] = nxt - tdex - 1
+    work[..., 2] = nxt < tdex.shape[0]
+    work[..., 3] = seen
+    return out
@@ -0,0 +1,132 @@
+import numpy as np
+
+import TimeSeriesTransforms as tstf
+
+
+def densify(entity, time, eventtype, end=None, nseq=None, start=None,
+            eventtypes=None, nanis=-1., out=None, dtype=float):
+    '''
+    y, entities, eventtypes = densify(entity, time, eventtype)
+    
+    convert a long table of arrivals (entity, time, eventtype) into the dense
+        y of shape (nentities, nseq, neventtypes, 4) expected by the loss
+        last axis is (tse, tte, unc, purchstatus)
+    time is in integer periods, the last period in y is end (default latest arrival)
+    start is when each entity is first observed (default first arrival)
+        either a scalar or an array aligned with the returned entities
+    periods before start are left padded with nanis for masking
+    arrivals before start are dropped, the latest one before end-nseq+1 only carries tse and purchstatus into y
+    rows of y follow the sorted unique entities, same for eventtypes
+    '''
+    entity, time, eventtype = np.asarray(entity), np.asarray(time), np.asarray(eventtype)
+    
+    # one sort to index entities, event types are few
+    entities, edex = np.unique(entity, return_inverse=True)
+    if eventtypes is None:
+        eventtypes = np.unique(eventtype)
+    kdex = np.searchsorted(eventtypes, eventtype)
+    nent, nev = len(entities), len(eventtypes)
+    
+    if end is None:
+        end = np.max(time)
+    if start is None:
+        start = np.full(nent, end, dtype=time.dtype)
+        np.minimum.at(start, edex, time)
+    start = np.broadcast_to(start, (nent,))
+    if nseq is None:
+        nseq = int(end - np.min(start)) + 1
+    
+    # scatter arrivals into indicators, time axis ends at end
+    tdex = nseq - 1 - (end - time)
+    keep = (tdex >= 0) & (tdex < nseq) & (time >= start[edex])
+    indicators = np.zeros((nent, nseq, nev), dtype=bool)
+    indicators[edex[keep], tdex[keep], kdex[keep]] = True
+    
+    # steps from the latest arrival cut off by the window to its first step, 0 if none
+    early = (tdex < 0) & (time >= start[edex])
+    before = np.full((nent, nev), np.iinfo(np.int64).max)
+    np.minimum.at(before, (edex[early], kdex[early]), -tdex[early].astype(np.int64))
+    before[before == np.iinfo(np.int64).max] = 0
+    
+    if out is None:
+        out = np.empty((nent, nseq, nev, 4), dtype=dtype)
+    tstf.transform_nd(indicators, axis=1, out=out, before=before)
+    del indicators
+    
+    # tse counts from start and not from beginning of window if no arrival yet
+    startat = (nseq - 1 - (end - start)).astype(int)
+    out[..., 0] -= np.minimum(startat, nseq)[:, None, None] * (1 - out[..., 3])
+    startat = np.clip(startat, 0, nseq)
+    
+    # left padding
+    padded = np.arange(nseq)[None, :] < startat[:, None]
+    out[padded] = nanis
+    
+    return out, entities, eventtypes
+
+
+def sparsify(entity, time, feature, value=None, end=None, nseq=None, start=None,
+             entities=None, features=None, nnz=None, nanis=-1., dtype=float, idxdtype=np.int32):
+    '''
+    idx, val, entities, features = sparsify(entity, time, feature, value)
+    
+    convert a long table of sparse covariates (entity, time, feature, value) into
+        idx, val of shape (nentities, nseq, nnz), nnz (index, value) slots per period
+        for klayers.SparseEmbedding, appended after the dense covariates of m
+    idx is 1 + position of the feature in features, 0 for an empty slot, value defaults to 1
+        idx is stored as idxdtype integers and val as dtype, see dataset.getparts to keep them apart on disk
+    rows of the same (entity, time) fill slots by decreasing |value|, those beyond nnz are dropped
+        nnz defaults to the most nonzeros of any (entity, time)
+    end, nseq, start and left padding with nanis are as in densify
+    pass entities (and the same end, nseq, start) from densify for rows aligned with its y
+    rows of entities or features not in the given ones are dropped
+    '''
+    entity, time, feature = np.asarray(entity), np.asarray(time), np.asarray(feature)
+    value = np.ones(len(entity)) if value is None else np.asarray(value, dtype=float)
+    
+    if entities is None:
+        entities = np.unique(entity)
+    if features is None:
+        features = np.unique(feature)
+    nent = len(entities)
+    edex = np.clip(np.searchsorted(entities, entity), 0, max(nent-1, 0))
+    fdex = np.clip(np.searchsorted(features, feature), 0, max(len(features)-1, 0))
+    keep = (entities[edex] == entity) & (features[fdex] == feature) & (value != 0)
+    
+    if end is None:
+        end = np.max(time)
+    if start is None:
+        start = np.full(nent, end, dtype=time.dtype)
+        np.minimum.at(start, edex[keep], time[keep])
+    start = np.broadcast_to(start, (nent,))
+    if nseq is None:
+        nseq = int(end - np.min(start)) + 1
+    
+    tdex = nseq - 1 - (end - time)
+    keep &= (tdex >= 0) & (tdex < nseq) & (time >= start[edex])
+    edex, tdex, fdex, value = edex[keep], tdex[keep], fdex[keep], value[keep]
+    
+    # rank of each row within its (entity, time) cell, largest |value| first
+    order = np.lexsort((-np.abs(value), tdex, edex))
+    edex, tdex, fdex, value = edex[order], tdex[order], fdex[order], value[order]
+    cell = edex*nseq + tdex
+    pos = np.arange(len(cell))
+    first = np.ones(len(cell), dtype=bool)
+    first[1:] = cell[1:] != cell[:-1]
+    rank = pos - np.maximum.accumulate(np.where(first, pos, 0))
+    if nnz is None:
+        nnz = int(np.max(rank)) + 1 if len(rank) > 0 else 1
+    slot = rank < nnz
+    
+    idx = np.zeros((nent, nseq, nnz), dtype=idxdtype)
+    val = np.zeros((nent, nseq, nnz), dtype=dtype)
+    idx[edex[slot], tdex[slot], rank[slot]] = fdex[slot] + 1
+    val[edex[slot], tdex[slot], rank[slot]] = value[slot]
+    
+    # left padding
+    startat = np.clip(nseq - 1 - (end - start), 0, nseq).astype(int)
+    padded = np.arange(nseq)[None, :] < startat[:, None]
+    idx[padded] = nanis
+    val[padded] = nanis
+    
+    return idx, val, entities, features
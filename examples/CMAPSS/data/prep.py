@@ -0,0 +1,250 @@
+'''
+parallel version of data_localtrain.ipynb and data_localtest.ipynb
+
+    python prep.py --fnames train_FD001.txt --out ../mlocaltrain --intraining
+    python prep.py --fnames test_FD001.txt --out ../mlocaltest --dscalingfrom ../mlocaltrain
+
+    python prep.py --fnames train_FD001.txt --sparse events_FD001.csv --nnz 8 --out ../mlocaltrain --intraining
+
+sparse covariates are read from csv files with columns (unitdex, time, feature, value), one per file of fnames,
+and appended as nnz (index, value) slots per timestep, see eventlog.sparsify and klayers.SparseEmbedding
+their features and nnz are saved with the dataset and reused with --dscalingfrom
+
+files are read, covariate min/max reduced and units written in a process pool
+each worker writes its units straight into one memory-mapped shard of the output dataset
+and returns streamstats.StreamingStats of its units, merged and saved with the dataset
+'''
+import os
+import sys
+import gzip
+import pickle
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import TimeSeriesTransforms as tstf
+import eventlog
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import dataset
+import streamstats
+
+
+nanis = -1
+SPARSE = 'sparse.npz'
+
+colnames = ['unitdex', 'time', 'control0', 'control1', 'control2',
+            'x0', 'x1', 'x2', 'x3', 'x4', 'x5', 'x6', 'x7', 'x8', 'x9',
+            'x10', 'x11', 'x12', 'x13', 'x14', 'x15', 'x16', 'x17', 'x18', 'x19',
+            'x20', 'x21', 'x22', 'x23', 'x24', 'x25']
+
+
+def readfile(fname):
+    return pd.read_csv(fname, header = None, sep = ' ', names = colnames)
+
+
+def covstats(block):
+    '''streamstats.StreamingStats of a block of covariate rows'''
+    return streamstats.StreamingStats(ncov=block.shape[1], seed=0).updatecov(block)
+
+
+def getdscaling(pool, cov, covcolnames, nchunks, q=0.):
+    '''
+    covariate (min, max) as a parallel reduction over row chunks
+    if q > 0, (q, 1-q) quantiles instead for ranges robust to outliers
+    '''
+    stats = streamstats.merge(pool.map(covstats, np.array_split(cov, nchunks)))
+    return stats.dscaling(covcolnames, q=q)
+
+
+# set in workers by the pool initializer, inherited without copying when forked
+_shared = {}
+
+
+def initworker(path, cov, unitstarts, MAXT, intraining, sparse=None):
+    _shared.update(path=path, cov=cov, unitstarts=unitstarts, MAXT=MAXT, intraining=intraining, sparse=sparse)
+    _shared['out'] = dataset.load(path, mode='r+')
+
+
+def fillunits(bounds):
+    '''
+    same as get_single for units lo..hi-1, written into the output dataset
+    '''
+    lo, hi = bounds
+    cov, unitstarts, MAXT = _shared['cov'], _shared['unitstarts'], _shared['MAXT']
+    NCOV = cov.shape[1]
+    maxtimes = np.diff(unitstarts[lo:hi+1])
+    startat = MAXT - maxtimes
+
+    block = np.empty((hi-lo, MAXT, 4+NCOV))
+    block[:] = nanis
+
+    # covariates of every row of these units, right aligned at MAXT
+    rows = np.arange(unitstarts[lo], unitstarts[hi])
+    unitlocal = np.repeat(np.arange(hi-lo), maxtimes)
+    tdex = startat[unitlocal] + rows - unitstarts[lo:hi][unitlocal]
+    covblock = cov[rows]
+    covblock[np.isnan(covblock)] = 0
+    block[unitlocal, tdex, 4:4+NCOV] = covblock
+
+    # failure occured right after final time step for every unit
+    indicator = np.zeros((hi-lo, MAXT+1))
+    indicator[:, -1] = 1
+    ts = tstf.transform_nd(indicator, axis=1)[:, :MAXT, :]
+    # tse counts from start of each unit
+    tse = ts[..., 0] - startat[:, None]
+    observed = np.arange(MAXT)[None, :] >= startat[:, None]
+    block[..., 0] = np.where(observed, tse, nanis)
+    block[..., 1] = np.where(observed, ts[..., 1], nanis)
+    # unc: all observations in training are uncensored if intraining
+    block[..., 2] = np.where(observed, 1 if _shared['intraining'] else 0, nanis)
+    # pcs
+    block[..., 3] = np.where(observed, 1, nanis)
+
+    stats = streamstats.StreamingStats(ncov=NCOV, seed=lo).update(block)
+    if _shared['sparse'] is not None:
+        idx, val = _shared['sparse']
+        block = np.concatenate([block, idx[lo:hi], val[lo:hi]], axis=-1)
+    _shared['out'][lo:hi] = block
+    _shared['out'].flush()
+    return stats
+
+
+def getsparse(sparsefnames, unitoffsets, units, unitstarts, MAXT, nnz=None, features=None, datadir='CMAPSSData'):
+    '''
+    (idx, val, features) of shape (nunits, MAXT, nnz) aligned with the units of the dense block
+    sparsefnames are csv files (unitdex, time, feature, value), unitdex of file k is offset by unitoffsets[k]
+    time counts cycles from 1 as in the CMAPSS files, each unit ends at MAXT-1
+    '''
+    slist = [pd.read_csv(os.path.join(datadir, fname)) for fname in sparsefnames]
+    for stemp, offset in zip(slist, unitoffsets):
+        stemp.loc[:, 'unitdex'] += offset
+    s = pd.concat(slist)
+    unit = np.array(s['unitdex'])
+    # right aligned like fillunits, startat is where time 1 of each unit goes
+    startat = MAXT - np.diff(unitstarts)
+    udex = np.clip(np.searchsorted(units, unit), 0, len(units)-1)
+    time = startat[udex] + np.array(s['time'], dtype=int) - 1
+    value = np.array(s['value'], dtype=float) if 'value' in s.columns else None
+    # rows of units not in the dense files are dropped by sparsify
+    # a plain string or integer array, not pandas objects, so that features save without pickle
+    feature = np.array(s['feature'].tolist())
+    idx, val, _, features = eventlog.sparsify(unit, time, feature, value, end=MAXT-1, nseq=MAXT,
+                                             start=startat, entities=units, features=features, nnz=nnz,
+                                             nanis=nanis)
+    return idx, val, features
+
+
+def prep(fnames, out, intraining, dscaling=None, nprocs=None, shardsize=1024, datadir='CMAPSSData', q=0.,
+         eventdtype=None, covdtype=None, sparse=None, nnz=None, features=None):
+    '''
+    write dataset at out for CMAPSS files fnames
+    dscaling is computed from these files unless given, see getdscaling for q
+    covariates are stored as covdtype and, if eventdtype, (tse, tte, unc, pcs) as eventdtype
+        e.g. np.int16 and np.float16, see dataset.getparts, float by default
+    sparse, if given, is a csv file of sparse covariates for each of fnames, see getsparse
+        nnz and features default to those of the data, pass the training ones for test data
+        slots are not scaled and not in dscaling or the dataset stats
+    returns (dataset.ShardedArray, dscaling)
+    '''
+    nprocs = multiprocessing.cpu_count() if nprocs is None else nprocs
+    pool = multiprocessing.Pool(nprocs)
+
+    dlist = pool.map(readfile, [os.path.join(datadir, fnametemp) for fnametemp in fnames])
+    unitdexmax = 0
+    unitoffsets = []
+    for dtemp in dlist:
+        unitoffsets.append(unitdexmax)
+        if unitdexmax > 0:
+            dtemp.loc[:, 'unitdex'] += unitdexmax
+        unitdexmax = np.max(np.array(dtemp.loc[:, 'unitdex'], dtype = int))
+    d = pd.concat(dlist)
+    d = d.loc[:, d.columns.values[:26]]
+    d = d.sort_values(['unitdex', 'time'], kind='mergesort')
+    print ('loaded', len(d), 'rows, unitdexmax:', unitdexmax)
+
+    covcolnames = d.columns.values[2:]
+    cov = np.array(d.loc[:, covcolnames], dtype=float)
+    if dscaling is None:
+        dscaling = getdscaling(pool, cov, covcolnames, nprocs, q=q)
+    mintemp = .9*np.array(dscaling.loc[covcolnames, 'min'])
+    maxtemp = 1.1*np.array(dscaling.loc[covcolnames, 'max'])
+    cov = 2*((cov - mintemp) / (maxtemp - mintemp)) - 1
+
+    units, unitstarts = np.unique(np.array(d.loc[:, 'unitdex']), return_index=True)
+    unitstarts = np.append(unitstarts, len(d))
+    MAXT = int(np.max(np.diff(unitstarts))) + 1
+    NCOV = len(covcolnames)
+    pool.close()
+
+    sparseslots = None
+    if sparse is not None:
+        idx, val, features = getsparse(sparse, unitoffsets, units, unitstarts, MAXT, nnz=nnz,
+                                       features=features, datadir=datadir)
+        sparseslots, nnz = (idx, val), idx.shape[-1]
+    else:
+        nnz = 0
+        print ('sparse covariates:', len(features), 'features in', nnz, 'slots')
+
+    covdtype = float if covdtype is None else covdtype
+    parts = None
+    if eventdtype is not None or nnz > 0:
+        # indices in their own integer part so that they stay exact
+        parts = dataset.getparts(1, NCOV, eventdtype=covdtype if eventdtype is None else eventdtype,
+                                 covdtype=covdtype, nnz=nnz)
+    m = dataset.create(out, (len(units), MAXT, 4+NCOV+2*nnz), dtype=covdtype, shardsize=shardsize,
+                       dscaling=dscaling, parts=parts)
+    del m
+    if nnz > 0:
+        np.savez(os.path.join(out, SPARSE), features=features, nnz=nnz)
+    # one task per shard so that no two workers write the same file
+    manifest = dataset.loadmanifest(out)
+    shardbounds = np.cumsum([0] + [s['nobs'] for s in manifest['shards']])
+    pool = multiprocessing.Pool(nprocs, initializer=initworker,
+                                initargs=(out, cov, unitstarts, MAXT, intraining, sparseslots))
+    stats = streamstats.merge(pool.map(fillunits, list(zip(shardbounds[:-1], shardbounds[1:]))))
+    pool.close()
+    pool.join()
+    dataset.savestats(out, stats)
+    print ('wrote', stats.nobs, 'units of shape', (MAXT, 4+NCOV+2*nnz), 'to', out)
+    print ('iniscale:', stats.iniscale(), 'censoring:', stats.censoring())
+
+    return dataset.load(out), dscaling
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--fnames', nargs='+', default=['train_FD001.txt'])
+    parser.add_argument('--out', required=True, help='output dataset directory')
+    parser.add_argument('--intraining', action='store_true')
+    parser.add_argument('--dscalingfrom', default=None, help='dataset directory or dscaling.pkl4 to reuse scaling from')
+    parser.add_argument('--nprocs', type=int, default=None)
+    parser.add_argument('--shardsize', type=int, default=1024)
+    parser.add_argument('--datadir', default='CMAPSSData')
+    parser.add_argument('--q', type=float, default=0., help='quantiles (q, 1-q) as covariate range instead of (min, max)')
+    parser.add_argument('--eventdtype', default=None, help='e.g. int16 to store (tse, tte, unc, pcs) as integers')
+    parser.add_argument('--covdtype', default=None, help='e.g. float32 or float16 to store covariates in')
+    parser.add_argument('--sparse', nargs='+', default=None,
+                        help='csv files (unitdex, time, feature, value) of sparse covariates, one per file of fnames')
+    parser.add_argument('--nnz', type=int, default=None, help='sparse slots per timestep, default the most nonzeros')
+    args = parser.parse_args(args)
+
+    dscaling, nnz, features = None, args.nnz, None
+    if args.dscalingfrom is not None:
+        if os.path.isdir(args.dscalingfrom):
+            dscaling = dataset.loaddscaling(args.dscalingfrom)
+            if args.sparse is not None and os.path.isfile(os.path.join(args.dscalingfrom, SPARSE)):
+                saved = np.load(os.path.join(args.dscalingfrom, SPARSE))
+                nnz, features = int(saved['nnz']), saved['features']
+        else:
+            dscaling = pickle.load(gzip.open(args.dscalingfrom, 'rb'))
+
+    prep(args.fnames, args.out, args.intraining, dscaling=dscaling,
+         nprocs=args.nprocs, shardsize=args.shardsize, datadir=args.datadir, q=args.q,
+         eventdtype=args.eventdtype, covdtype=args.covdtype, sparse=args.sparse, nnz=nnz, features=features)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,321 @@
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+import streamstats
+
+
+MANIFEST = 'manifest.json'
+STATS = 'stats.npz'
+
+
+def _firstkey(key, ndim):
+    '''split key into index along first axis and the rest'''
+    if not isinstance(key, tuple):
+        key = (key,)
+    if len(key) > 0 and key[0] is Ellipsis:
+        # leading ellipsis, e.g. m[..., 0], expanded to full slices
+        key = (slice(None),)*(ndim - len(key) + 1) + key[1:]
+    if len(key) == 0:
+        key = (slice(None),)
+    return key[0], key[1:]
+
+
+class _FirstAxisIndexing(object):
+    '''
+    numpy-like indexing along the first axis for arrays read in chunks
+    subclasses implement _getchunk(lo, hi, rest) and set shape, bounds
+    bounds are the chunk boundaries along the first axis
+    '''
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __getitem__(self, key):
+        first, rest = _firstkey(key, self.ndim)
+
+        if isinstance(first, (int, np.integer)):
+            return self._getindex(self._normindex(np.array([first])), rest)[0]
+
+        if isinstance(first, slice):
+            start, stop, step = first.indices(len(self))
+            if step == 1:
+                # one part per chunk so memory stays bounded by chunk size
+                los = np.clip(self.bounds, start, max(start, stop))
+                parts = [self._getchunk(lo, hi, rest) for lo, hi in zip(los[:-1], los[1:]) if hi > lo]
+                if len(parts) == 0:
+                    return self._getchunk(start, start, rest)
+                return np.concatenate(parts)
+            first = np.arange(start, stop, step)
+
+        first = np.asarray(first)
+        if first.dtype == bool:
+            first = np.nonzero(first)[0]
+        return self._getindex(self._normindex(first), rest)
+
+    def _normindex(self, idx):
+        '''negative indices counted from the end, IndexError if out of bounds like numpy'''
+        idx = np.where(idx < 0, idx + len(self), idx)
+        if idx.size > 0 and (idx.min() < 0 or idx.max() >= len(self)):
+            raise IndexError('index out of bounds for axis 0 with size %d' % len(self))
+        return idx
+
+    def _getindex(self, idx, rest):
+        '''gather rows idx, reading each chunk once'''
+        chunkdex = np.searchsorted(self.bounds, idx, side='right') - 1
+        order = np.argsort(chunkdex, kind='mergesort')
+        parts = []
+        for c in np.unique(chunkdex):
+            sel = idx[order][chunkdex[order] == c]
+            lo, hi = self.bounds[c], self.bounds[c+1]
+            parts.append(self._getchunk(lo, hi, (sel - lo,) + rest, gather=True))
+        if len(parts) == 0:
+            return self._getchunk(0, 0, rest)
+        out = np.concatenate(parts)
+        # back to requested order
+        return out[np.argsort(order, kind='mergesort')]
+
+    def map(self, fn, shape):
+        '''lazy array of fn applied to each chunk as it is read'''
+        return MappedArray(self, fn, shape)
+
+
+class ShardedArray(_FirstAxisIndexing):
+    '''
+    array stored as memory-mapped .npy shards along the first axis
+    indexing reads only the shards it touches
+    '''
+
+    def __init__(self, shards):
+        self.shards = shards
+        self.bounds = np.cumsum([0] + [len(s) for s in shards])
+        self.shape = (int(self.bounds[-1]),) + shards[0].shape[1:]
+        self.dtype = shards[0].dtype
+
+    def _getchunk(self, lo, hi, rest, gather=False):
+        c = max(0, min(np.searchsorted(self.bounds, lo, side='right') - 1, len(self.shards) - 1))
+        shard = self.shards[c]
+        if gather:
+            return np.asarray(shard[rest[0]][(slice(None),) + rest[1:]])
+        lo, hi = lo - self.bounds[c], hi - self.bounds[c]
+        return np.array(shard[(slice(lo, hi),) + rest])
+
+    def __setitem__(self, key, value):
+        '''assign rows in a slice along the first axis, for shards opened with mode r+'''
+        first, rest = _firstkey(key, self.ndim)
+        start, stop, step = first.indices(len(self))
+        value = np.broadcast_to(value, (stop - start,) + self.shape[1:])
+        for c, shard in enumerate(self.shards):
+            lo, hi = max(start, self.bounds[c]), min(stop, self.bounds[c+1])
+            if hi > lo:
+                shard[(slice(lo - self.bounds[c], hi - self.bounds[c]),) + rest] = value[lo-start:hi-start]
+
+    def flush(self):
+        for shard in self.shards:
+            if isinstance(shard, (np.memmap, PartedShard)):
+                shard.flush()
+
+
+class PartedShard(object):
+    '''
+    shard stored as memory-mapped parts along the last axis, each in its own dtype
+    e.g. (tse, tte, unc, pcs) as small integers and covariates as float16
+    reads give the parts concatenated in their common dtype
+    '''
+
+    def __init__(self, parts):
+        self.parts = parts
+        self.bounds = np.cumsum([0] + [p.shape[-1] for p in parts])
+        self.shape = parts[0].shape[:-1] + (int(self.bounds[-1]),)
+        self.dtype = np.result_type(*[p.dtype for p in parts])
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _splitkey(self, key):
+        '''key on all axes but the last, key on the last axis'''
+        if not isinstance(key, tuple):
+            key = (key,)
+        ndim = len(self.shape)
+        ellipsis = [k for k, part in enumerate(key) if part is Ellipsis]
+        if len(ellipsis) > 1:
+            raise IndexError('an index can only have a single ellipsis')
+        if len(ellipsis) == 1:
+            # expand to full slices, None would add axes and is not supported
+            k = ellipsis[0]
+            key = key[:k] + (slice(None),)*(ndim - len(key) + 1) + key[k+1:]
+        return key[:ndim-1], key[ndim-1:]
+
+    def __getitem__(self, key):
+        lead, last = self._splitkey(key)
+        out = np.concatenate([np.asarray(p[lead], dtype=self.dtype) for p in self.parts], axis=-1)
+        return out[(Ellipsis,) + last] if len(last) > 0 else out
+
+    def __setitem__(self, key, value):
+        lead, last = self._splitkey(key)
+        if len(last) > 0:
+            raise IndexError('PartedShard is assigned along the whole last axis')
+        value = np.asarray(value)
+        for p, lo, hi in zip(self.parts, self.bounds[:-1], self.bounds[1:]):
+            part = value[..., lo:hi]
+            if p.dtype.kind in 'iu':
+                info = np.iinfo(p.dtype)
+                if not np.all((part >= info.min) & (part <= info.max)):
+                    raise ValueError('values do not fit in %s' % p.dtype)
+                part = np.rint(part)
+            p[lead] = part
+
+    def flush(self):
+        for p in self.parts:
+            p.flush()
+
+
+class MappedArray(_FirstAxisIndexing):
+    '''
+    lazy fn(source[rows]) for rows along the first axis
+    fn must map a chunk of shape (n, ...) to shape (n,) + shape[1:]
+    '''
+
+    def __init__(self, source, fn, shape):
+        self.source, self.fn = source, fn
+        self.shape = tuple(shape)
+        self.bounds = source.bounds
+
+    def _getchunk(self, lo, hi, rest, gather=False):
+        if gather:
+            chunk = self.source[lo + rest[0]]
+            rest = rest[1:]
+        else:
+            chunk = self.source[lo:hi]
+        return self.fn(chunk)[(slice(None),) + rest]
+
+    @property
+    def dtype(self):
+        return self._getchunk(0, 0, ()).dtype
+
+
+def getparts(neventtypes, ncov, eventdtype=np.int16, covdtype=np.float32, nnz=0, idxdtype=np.int32):
+    '''
+    parts for create storing (tse, tte, unc, pcs) of each event type as eventdtype and covariates as covdtype
+    int16 holds tse and tte up to 32767 periods, left padding -1 included
+    with nnz sparse slots (see data/eventlog.sparsify) after the ncov dense covariates
+        indices are stored as idxdtype, exact whatever covdtype, and values as covdtype
+        reads are in the common dtype, e.g. float64 for int32 indices, float32 for int16 indices and float16 values
+    '''
+    parts = [(4*neventtypes, eventdtype), (ncov, covdtype)]
+    if nnz > 0:
+        parts += [(nnz, idxdtype), (nnz, covdtype)]
+    return parts
+
+
+def create(path, shape, dtype=float, shardsize=1024, dscaling=None, parts=None):
+    '''
+    preallocate memory-mapped shards of shape[0] rows split by shardsize
+    parts, e.g. from getparts, is a list of (width, dtype) along the last axis stored in separate files
+        reads are then in the common dtype of the parts and dtype is ignored
+    returns the writable ShardedArray
+    '''
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    if parts is not None:
+        parts = [(int(width), np.dtype(partdtype)) for width, partdtype in parts]
+        if sum(width for width, _ in parts) != shape[-1]:
+            raise ValueError('widths of parts do not add up to %d' % shape[-1])
+        dtype = np.result_type(*[partdtype for _, partdtype in parts])
+    dtype = np.dtype(dtype)
+    shards = []
+    for k, lo in enumerate(range(0, max(1, shape[0]), shardsize)):
+        nobs = min(shardsize, shape[0] - lo)
+        if parts is None:
+            layout = [('shard%05d.npy' % k, dtype, shape[1:])]
+        else:
+            layout = [('shard%05d_part%d.npy' % (k, j), partdtype, tuple(shape[1:-1]) + (width,))
+                      for j, (width, partdtype) in enumerate(parts)]
+        for fname, filedtype, fileshape in layout:
+            shard = np.lib.format.open_memmap(os.path.join(path, fname), mode='w+',
+                                              dtype=filedtype, shape=(nobs,) + tuple(fileshape))
+            del shard
+        if parts is None:
+            shards.append({'fname': layout[0][0], 'nobs': nobs})
+        else:
+            shards.append({'fnames': [fname for fname, _, _ in layout], 'nobs': nobs})
+
+    manifest = {'shape': list(shape), 'dtype': dtype.str, 'shards': shards}
+    if parts is not None:
+        manifest['parts'] = [{'width': width, 'dtype': partdtype.str} for width, partdtype in parts]
+    if dscaling is not None:
+        manifest['dscaling'] = {'index': [str(i) for i in dscaling.index.values],
+                                'min': [float(v) for v in dscaling['min']],
+                                'max': [float(v) for v in dscaling['max']]}
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+    return load(path, mode='r+')
+
+
+def save(path, m, dscaling=None, shardsize=1024, neventtypes=1, dtype=None, parts=None):
+    '''
+    write m as .npy shards of shardsize rows plus manifest.json in directory path
+    dscaling is the DataFrame of covariate (min, max) used for scaling
+    streamstats.StreamingStats of m with neventtypes event types are gathered while writing
+    m is stored as dtype (default m.dtype), or split in parts as in create
+    '''
+    out = create(path, m.shape, m.dtype if dtype is None else dtype, shardsize=shardsize, dscaling=dscaling,
+                 parts=parts)
+    stats = streamstats.StreamingStats(neventtypes=neventtypes, ncov=m.shape[2]-4*neventtypes, seed=0)
+    for lo in range(0, len(m), shardsize):
+        chunk = m[lo:lo+shardsize]
+        out[lo:lo+shardsize] = chunk
+        stats.update(chunk)
+    out.flush()
+    savestats(path, stats)
+
+
+def savestats(path, stats):
+    '''
+    write streamstats.StreamingStats of the dataset in directory path
+    '''
+    stats.save(os.path.join(path, STATS))
+    manifest = loadmanifest(path)
+    manifest['stats'] = STATS
+    with open(os.path.join(path, MANIFEST), 'w') as f:
+        json.dump(manifest, f, indent=1)
+
+
+def loadstats(path):
+    '''
+    return streamstats.StreamingStats saved with the dataset
+    '''
+    return streamstats.StreamingStats.load(os.path.join(path, loadmanifest(path)['stats']))
+
+
+def loadmanifest(path):
+    with open(os.path.join(path, MANIFEST)) as f:
+        return json.load(f)
+
+
+def load(path, mode='r'):
+    '''
+    return ShardedArray reading shards in directory path lazily
+    '''
+    manifest = loadmanifest(path)
+    if 'parts' in manifest:
+        shards = [PartedShard([np.load(os.path.join(path, fname), mmap_mode=mode) for fname in s['fnames']])
+                  for s in manifest['shards']]
+    else:
+        shards = [np.load(os.path.join(path, s['fname']), mmap_mode=mode) for s in manifest['shards']]
+    return ShardedArray(shards)
+
+
+def loaddscaling(path):
+    '''
+    return DataFrame of covariate (min, max) saved with the dataset
+    '''
+    d = loadmanifest(path)['dscaling']
+    return pd.DataFrame({'min': d['min'], 'max': d['max']}, index=d['index'])
@@ -14,6 +14,7 @@ import pandas as pd
 import matplotlib.pyplot as plt
 
 import utils
+import dataset
 import matrnn_fitter as fitter
 
 
@@ -27,32 +28,39 @@ d = 2
 w = 64
 winlen = 78
 jobid = 'matrnn'
+# processes sharing each minibatch, see matrnn_parallel.py
+nworkers = 1
 
 
 # In[3]:
 
 
-mtrain = pickle.load(gzip.open('mlocaltrain.pkl', 'rb'))
-xtrain, ytrain = utils.split(mtrain)
-xtrainlong, ytrainlong = utils.getlongver(xtrain, ytrain, winlen)
-print ('xtrainlong.shape:', xtrainlong.shape)
-print ('ytrainlong.shape:', ytrainlong.shape)
+# convert once to memory-mapped shards, then read lazily
+if not os.path.isdir('mlocaltrain'):
+    dataset.save('mlocaltrain', pickle.load(gzip.open('mlocaltrain.pkl', 'rb')),
+                 dscaling=pickle.load(gzip.open('data/dscaling.pkl4', 'rb')))
+mtrain = dataset.load('mlocaltrain')
+xtrain, ytrain = utils.split(mtrain, dtype=np.float32)
+print ('xtrain.shape:', xtrain.shape)
+print ('ytrain.shape:', ytrain.shape)
 
 
 # In[4]:
 
 
-# compute iniscale taking mean time to occurence (i.e. the tse at time-1) for non-windowed observations
-iniscale = ytrain[:, -1, 0, 0]
-iniscale = np.mean(iniscale)
-print ('iniscale:', iniscale)
+# iniscale is the scale maximizing likelihood if shape is 1, from statistics gathered when saving the dataset
+# i.e. sum of (tse + tte) over sum of unc at the last timestep of each observation
+stats = dataset.loadstats('mlocaltrain')
+iniscale = stats.iniscale()[0]
+print ('iniscale:', iniscale, 'censoring:', stats.censoring()[0])
 
 
 # In[5]:
 
 
 model = fitter.MATRNN(modelspec_tuple=(d, w), jobid=jobid, iswtte=False)
-model.fit(xtrainlong, ytrainlong, iniscale=iniscale, epochs=epochs, batch_size=batch_size, lr=lr)
+model.fit(xtrain, ytrain, iniscale=iniscale, epochs=epochs, batch_size=batch_size, lr=lr, winlen=winlen,
+          nworkers=nworkers)
 
 
 # In[ ]:
@@ -70,12 +78,12 @@ print ('np.all(mtest==-1., axis=2)[0,...]:\n', np.all(mtest==-1., axis=2)[0,...]
 
 mtest = mtest[:,-winlen:,...]
 xtest, ytest = utils.split(mtest)
-inferred = model.infer(x=xtest)
+inferred = model.infer(x=xtest, laststep=True)
 
 
 # In[ ]:
 
 
-finalstate = inferred[:, -1, 0, :]
+finalstate = inferred[:, 0, :]
 finalstate_fname = 'finalstate_jobid' + str(jobid) + '_d' + str(d) + 'w' + str(w) + '.pkl'
 pickle.dump(finalstate, gzip.open(finalstate_fname, 'wb'))
\ No newline at end of file
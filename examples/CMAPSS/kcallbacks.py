@@ -1,4 +1,15 @@
 import os
+import glob
+import json
+import time
+import fcntl
+import sys
+import queue
+import resource
+import threading
+import contextlib
+import collections
+
 import keras
 import numpy as np
 from keras import backend as K
@@ -14,6 +25,137 @@ class SaveValidWeights(keras.callbacks.Callback):
             self.model.save_weights(self.weightsfname)
             
             
+class CheckpointManager(keras.callbacks.Callback):
+    '''
+    keep the last keep states of epochs with a valid loss in memory and on disk
+    a state is (epoch, model weights, optimizer weights, lr)
+    disk writes run in a background thread, each to a temporary file renamed into place
+        so a crash mid-write never leaves a broken checkpoint
+    checkpoints are ckptdir/epoch<epoch>.npz, ckptdir defaults to weightsfname without .h5 plus .ckpt
+    weightsfname is written once at the end of training for loadweights and infer
+    if resume, the latest checkpoint on disk is restored when training begins
+        otherwise checkpoints left in ckptdir by an earlier run are removed
+    '''
+    
+    def __init__(self, weightsfname, keep=3, ckptdir=None, resume=False):
+        self.weightsfname = weightsfname
+        self.keep, self.resume = keep, resume
+        self.ckptdir = os.path.splitext(weightsfname)[0] + '.ckpt' if ckptdir is None else ckptdir
+        self.states = collections.deque(maxlen=keep)
+        self.writes = queue.Queue()
+        self.error = None
+        self.writer = None
+        
+    def getstate(self, epoch):
+        optimizer = self.model.optimizer
+        return (epoch, K.batch_get_value(self.model.weights), K.batch_get_value(optimizer.weights),
+                float(K.get_value(optimizer.lr)))
+    
+    def setstate(self, state, setlr=False):
+        epoch, weights, optweights, lr = state
+        self.model.set_weights(weights)
+        self.model.optimizer.set_weights(optweights)
+        if setlr:
+            K.set_value(self.model.optimizer.lr, lr)
+    
+    def restore(self):
+        '''
+        set model to the latest state in memory without reading from disk
+        lr is left as it is, returns the epoch of the state or None if there is none
+        '''
+        if len(self.states) == 0:
+            return None
+        self.setstate(self.states[-1])
+        return self.states[-1][0]
+    
+    def ckptfnames(self):
+        return sorted(glob.glob(os.path.join(self.ckptdir, 'epoch*.npz')))
+    
+    def lastepoch(self):
+        '''epoch of the latest checkpoint on disk, -1 if there is none'''
+        fnames = self.ckptfnames()
+        if len(fnames) == 0:
+            return -1
+        return int(os.path.basename(fnames[-1])[len('epoch'):-len('.npz')])
+    
+    def load(self, fname):
+        arrs = np.load(fname)
+        nw = len([k for k in arrs.files if k.startswith('w')])
+        no = len([k for k in arrs.files if k.startswith('o')])
+        return (int(arrs['epoch']), [arrs['w%d' % k] for k in range(nw)], [arrs['o%d' % k] for k in range(no)],
+                float(arrs['lr']))
+    
+    def write(self, state):
+        epoch, weights, optweights, lr = state
+        arrs = {'epoch': epoch, 'lr': lr}
+        arrs.update(('w%d' % k, wt) for k, wt in enumerate(weights))
+        arrs.update(('o%d' % k, wt) for k, wt in enumerate(optweights))
+        fname = os.path.join(self.ckptdir, 'epoch%06d.npz' % epoch)
+        with open(fname + '.tmp', 'wb') as f:
+            np.savez(f, **arrs)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(fname + '.tmp', fname)
+        for fnameold in self.ckptfnames()[:-self.keep]:
+            os.remove(fnameold)
+    
+    def writeloop(self):
+        while True:
+            state = self.writes.get()
+            try:
+                if state is not None and self.error is None:
+                    self.write(state)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.writes.task_done()
+            if state is None:
+                break
+    
+    def flush(self):
+        '''wait for pending writes, raise if one failed'''
+        self.writes.join()
+        if self.error is not None:
+            raise self.error
+    
+    def on_train_begin(self, logs={}):
+        if not os.path.isdir(self.ckptdir):
+            os.makedirs(self.ckptdir)
+        if self.resume and self.lastepoch() >= 0:
+            state = self.load(self.ckptfnames()[-1])
+            self.setstate(state, setlr=True)
+            self.states.append(state)
+            print ('resumed from epoch', state[0])
+        elif not self.resume:
+            # stale checkpoints of higher epochs would outlive this run's in the rotation
+            for fname in self.ckptfnames() + glob.glob(os.path.join(self.ckptdir, 'epoch*.npz.tmp')):
+                os.remove(fname)
+        self.writer = threading.Thread(target=self.writeloop)
+        self.writer.daemon = True
+        self.writer.start()
+        
+    def on_epoch_end(self, epoch, logs={}):
+        if self.error is not None:
+            raise self.error
+        loss = logs.get('loss')
+        if not np.isnan(loss):
+            state = self.getstate(epoch)
+            self.states.append(state)
+            self.writes.put(state)
+            
+    def on_train_end(self, logs={}):
+        self.writes.put(None)
+        self.flush()
+        self.writer.join()
+        if len(self.states) > 0:
+            # weights of last good epoch for loadweights and infer, renamed into place as well
+            self.setstate(self.states[-1])
+            root, ext = os.path.splitext(self.weightsfname)
+            tmpfname = root + '.tmp' + ext
+            self.model.save_weights(tmpfname)
+            os.replace(tmpfname, self.weightsfname)
+            
+            
 class EarlyStopping(keras.callbacks.Callback):
     
     def __init__(self, patience=20, logsget='val_loss'):
@@ -24,11 +166,11 @@ class EarlyStopping(keras.callbacks.Callback):
         
     def on_epoch_end(self, epoch, logs={}):
         losstemp = logs.get(self.logsget)
-        # update tracker
+        # update tracker, epochs without improvement (worse, equal or nan) count towards patience
         if losstemp < self.loss:
             self.loss = losstemp
             self.wait = 0
-        elif losstemp == self.loss:
+        else:
             self.wait += 1
         # stop training if wait beyond patience
         if self.wait > self.patience:
@@ -36,15 +178,160 @@ class EarlyStopping(keras.callbacks.Callback):
             self.model.stop_training = True
             
             
+class RungTable(object):
+    '''
+    losses of runs at each rung, shared by processes through json lines in fname
+    records are (key, rung, jobid, loss), key groups runs that are compared, e.g. by model type
+    appends and reads hold an exclusive lock on the file
+    '''
+    
+    def __init__(self, fname):
+        self.fname = fname
+        
+    def record(self, key, rung, jobid, loss):
+        '''add loss of jobid and return losses of all runs recorded at (key, rung)'''
+        with open(self.fname, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.write(json.dumps({'key': key, 'rung': rung, 'jobid': jobid, 'loss': loss}) + '\n')
+                f.flush()
+                f.seek(0)
+                records = [json.loads(line) for line in f if line.strip()]
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return [r['loss'] for r in records if r['key'] == key and r['rung'] == rung]
+    
+    
+class ASHA(keras.callbacks.Callback):
+    '''
+    asynchronous successive halving across concurrent runs sharing a RungTable
+    rungs are at epochs minepochs * eta**k, at each rung a run records its best loss so far
+    and stops unless it is within the best 1/eta of losses recorded at that rung by runs with the same key
+    runs that stop early free their process for the next configuration
+    nan losses count as inf
+    '''
+    
+    def __init__(self, table, key, jobid, minepochs=1, eta=3, logsget='val_loss'):
+        self.table, self.key, self.jobid = table, key, jobid
+        self.minepochs, self.eta, self.logsget = minepochs, eta, logsget
+        self.best = float('inf')
+        self.rung = 0
+        self.stopped_rung = None
+        
+    def on_epoch_end(self, epoch, logs={}):
+        loss = logs.get(self.logsget)
+        if loss is not None and np.isfinite(loss):
+            self.best = min(self.best, float(loss))
+        if epoch + 1 < self.minepochs * self.eta**self.rung:
+            return
+        losses = np.array(self.table.record(self.key, self.rung, self.jobid, self.best))
+        cutoff = np.percentile(losses, 100. / self.eta)
+        if self.best > cutoff:
+            print ('stopped at rung %d, best %s: %e, cutoff: %e' % (self.rung, self.logsget, self.best, cutoff))
+            self.stopped_rung = self.rung
+            self.model.stop_training = True
+        self.rung += 1
+        
+        
+class BatchRetreat(keras.callbacks.Callback):
+    '''
+    check every minibatch for a non-finite loss or weights (non-finite gradients end up in the weights)
+    and roll back to an in-memory snapshot of weights and optimizer state with a reduced learning rate
+    snapshots are taken every snapshot_every good minibatches
+    if lr_recovery, learning rate is raised by 1/lr_factor after that many good minibatches in a row
+        up to where it started
+    place before CheckpointManager and TacticalRetreat, epoch loss is replaced by the mean over kept minibatches
+    retreats and batcheslost (minibatches undone by rollbacks) of the epoch are added to its logs
+    '''
+    
+    def __init__(self, lr_factor = .1, lr_min = np.finfo(float).eps, snapshot_every = 10, lr_recovery = None,
+                 checkweights = True):
+        self.lr_factor, self.lr_min = lr_factor, lr_min
+        self.snapshot_every, self.lr_recovery = snapshot_every, lr_recovery
+        self.checkweights = checkweights
+        self.retreats, self.batcheslost = 0, 0
+        
+    def snapshot(self):
+        self.state = (K.batch_get_value(self.model.weights), K.batch_get_value(self.model.optimizer.weights))
+        # minibatches since snapshot, and how many of them are in this epoch's losses
+        self.sincesnapshot, self.pending = 0, 0
+        
+    def isgood(self, loss):
+        if not np.isfinite(loss):
+            return False
+        if self.checkweights:
+            return all(np.all(np.isfinite(wt)) for wt in K.batch_get_value(self.model.trainable_weights))
+        return True
+    
+    def rollback(self):
+        self.model.set_weights(self.state[0])
+        self.model.optimizer.set_weights(self.state[1])
+        del self.losses[len(self.losses)-self.pending:]
+        self.retreats += 1
+        self.batcheslost += self.sincesnapshot
+        
+        lrnow = K.get_value(self.model.optimizer.lr)
+        lrnew = max(self.lr_min, lrnow * self.lr_factor)
+        K.set_value(self.model.optimizer.lr, lrnew)
+        print ('\nbad minibatch, rolled back %d minibatches, lrnow: %e, lrnew: %e' % (self.sincesnapshot, lrnow, lrnew))
+        self.sincesnapshot, self.pending, self.good = 0, 0, 0
+        if lrnew == self.lr_min:
+            print ('lrnew at min, stop training!')
+            self.model.stop_training = True
+            
+    def on_train_begin(self, logs={}):
+        self.lrmax = K.get_value(self.model.optimizer.lr)
+        self.losses, self.good = [], 0
+        self.snapshot()
+        
+    def on_epoch_begin(self, epoch, logs={}):
+        # (loss, size) of kept minibatches
+        self.losses, self.pending = [], 0
+        self.retreats, self.batcheslost = 0, 0
+        
+    def on_batch_end(self, batch, logs={}):
+        loss = logs.get('loss')
+        self.sincesnapshot += 1
+        if not self.isgood(loss):
+            self.rollback()
+            return
+        
+        self.losses.append((loss, logs.get('size', 1)))
+        self.pending += 1
+        self.good += 1
+        if self.lr_recovery is not None and self.good >= self.lr_recovery:
+            lrnow = K.get_value(self.model.optimizer.lr)
+            if lrnow < self.lrmax:
+                K.set_value(self.model.optimizer.lr, min(self.lrmax, lrnow / self.lr_factor))
+            self.good = 0
+        if self.sincesnapshot >= self.snapshot_every:
+            self.snapshot()
+            
+    def on_epoch_end(self, epoch, logs={}):
+        if 'loss' in logs:
+            size = sum(n for l, n in self.losses)
+            logs['loss'] = sum(l*n for l, n in self.losses) / float(size) if size > 0 else np.nan
+        logs['retreats'], logs['batcheslost'] = self.retreats, self.batcheslost
+        
+        
 class TacticalRetreat(keras.callbacks.Callback):
+    '''
+    on nan loss go back to the last good weights and reduce learning rate
+    with a CheckpointManager, the last good weights and optimizer state come from its memory
+    '''
     
-    def __init__(self, weightsfname, lr_factor = .1, lr_min = np.finfo(float).eps):
+    def __init__(self, weightsfname, lr_factor = .1, lr_min = np.finfo(float).eps, checkpoints = None):
         self.weightsfname = weightsfname
         self.lr_factor, self.lr_min = lr_factor, lr_min
+        self.checkpoints = checkpoints
         
     def loadlastgood(self):
         print ('\nretrieve last good weights...')
-        if os.path.isfile(self.weightsfname):
+        if self.checkpoints is not None:
+            if self.checkpoints.restore() is None:
+                print ('no last good weights, stop training')
+                self.model.stop_training = True
+        elif os.path.isfile(self.weightsfname):
             self.model.load_weights(self.weightsfname)
         else:
             print ('no last good weights, stop training')
@@ -66,3 +353,110 @@ class TacticalRetreat(keras.callbacks.Callback):
             if lrnew == self.lr_min:
                 print ('lrnew at min, stop training!')
                 self.model.stop_training = True
+                
+                
+def peakrss():
+    '''peak resident set size of this process in bytes'''
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    return rss if sys.platform == 'darwin' else rss*1024
+                
+                
+class Telemetry(keras.callbacks.Callback):
+    '''
+    write one json line per epoch to fname with
+        seconds, samples and samplespersec
+        feedseconds waiting for minibatches (between the end of one and the start of the next)
+        computeseconds running minibatches (forward, loss, backward and update together)
+        losskernelseconds, the part of computeseconds spent in the loss, if loss and losssample are given
+        peakrss, and loss, val_loss, lr, retreats, batcheslost when in logs
+    losskernelseconds is measured every probeevery minibatches on a minibatch-sized slice of losssample (x, y)
+        as the time of forward and loss minus the time of forward alone, with the graph of the training step
+        and scaled to the number of minibatches of the epoch; probe time is left out of the other timings
+    phase(name) is a context manager writing one line with the time spent inside it
+    place after BatchRetreat to get its counts
+    '''
+    
+    def __init__(self, fname, loss=None, losssample=None, probeevery=50):
+        self.fname = fname
+        self.loss, self.losssample = loss, losssample
+        self.probeevery = probeevery
+        self.probe = None
+        
+    def write(self, record):
+        record['time'] = time.strftime('%Y-%m-%dT%H:%M:%S')
+        with open(self.fname, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+            
+    @contextlib.contextmanager
+    def phase(self, name):
+        t0 = time.time()
+        yield
+        self.write({'event': 'phase', 'phase': name, 'seconds': time.time()-t0, 'peakrss': peakrss()})
+        
+    def on_train_begin(self, logs={}):
+        if self.loss is not None and self.losssample is not None:
+            x, y = self.losssample
+            batch_size = self.params.get('batch_size') or len(y)
+            x, y = x[:batch_size], y[:batch_size]
+            ytrue_ph = K.placeholder(ndim=K.ndim(self.model.outputs[0]))
+            # run as in training, e.g. with dropout
+            phase, phasein = [], []
+            if self.model.uses_learning_phase and not isinstance(K.learning_phase(), int):
+                phase, phasein = [K.learning_phase()], [1]
+            forward = K.function(self.model.inputs + phase, self.model.outputs)
+            withloss = K.function(self.model.inputs + [ytrue_ph] + phase,
+                                  [K.mean(self.loss(ytrue_ph, self.model.outputs[0]))])
+            
+            def probe():
+                t0 = time.time()
+                forward([x] + phasein)
+                t1 = time.time()
+                withloss([x, y] + phasein)
+                return max(0., (time.time() - t1) - (t1 - t0))
+            # first calls build the graphs
+            probe()
+            self.probe = probe
+        
+    def on_epoch_begin(self, epoch, logs={}):
+        self.t0 = self.tlast = time.time()
+        self.samples, self.feedseconds, self.computeseconds = 0, 0., 0.
+        self.batches, self.losstimes, self.probeseconds = 0, [], 0.
+        
+    def on_batch_begin(self, batch, logs={}):
+        now = time.time()
+        self.feedseconds += now - self.tlast
+        self.tlast = now
+        
+    def on_batch_end(self, batch, logs={}):
+        now = time.time()
+        self.computeseconds += now - self.tlast
+        self.tlast = now
+        self.samples += int(logs.get('size', 0))
+        if self.probe is not None and self.batches % self.probeevery == 0:
+            self.losstimes.append(self.probe())
+            self.tlast = time.time()
+            self.probeseconds += self.tlast - now
+        self.batches += 1
+        
+    def on_epoch_end(self, epoch, logs={}):
+        seconds = time.time() - self.t0 - self.probeseconds
+        record = {'event': 'epoch', 'epoch': epoch, 'seconds': seconds, 'samples': self.samples,
+                  'samplespersec': self.samples / seconds if seconds > 0 else float('inf'),
+                  'feedseconds': self.feedseconds, 'computeseconds': self.computeseconds,
+                  'peakrss': peakrss()}
+        if self.losstimes:
+            record['losskernelseconds'] = min(self.computeseconds, np.mean(self.losstimes) * self.batches)
+        for key in ['loss', 'val_loss']:
+            if key in logs:
+                record[key] = float(logs[key])
+        for key in ['retreats', 'batcheslost']:
+            if key in logs:
+                record[key] = int(logs[key])
+        record['lr'] = float(K.get_value(self.model.optimizer.lr))
+        self.write(record)
+        
+        
+def phase(telemetry, name):
+    '''telemetry.phase(name), or a context manager doing nothing if telemetry is None'''
+    return contextlib.nullcontext() if telemetry is None else telemetry.phase(name)
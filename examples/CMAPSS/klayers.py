@@ -0,0 +1,42 @@
+import keras.backend as K
+from keras.engine import Layer
+
+
+class SparseEmbedding(Layer):
+    '''
+    first layer for sparse covariates given as nnz (index, value) slots per timestep
+        x[..., :] = (dense columns..., index x nnz, value x nnz), e.g. from data/eventlog.sparsify
+    indices are 1..nsparse, 0 marks an empty slot
+    output is (dense columns..., sum over slots of value * embeddings[index])
+        i.e. the dense covariate vector times an (nsparse, nembed) matrix without densifying it
+        so memory and compute scale with nnz and not with nsparse
+    timesteps where x is all -1 stay all -1 for the Masking layer that follows
+    '''
+
+    def __init__(self, nnz, nsparse, nembed, **kwargs):
+        super(SparseEmbedding, self).__init__(**kwargs)
+        self.nnz, self.nsparse, self.nembed = nnz, nsparse, nembed
+
+    def build(self, input_shape):
+        self.ndense = input_shape[-1] - 2*self.nnz
+        self.embeddings = self.add_weight(name='embeddings', shape=(self.nsparse+1, self.nembed),
+                                          initializer='glorot_uniform')
+        super(SparseEmbedding, self).build(input_shape)
+
+    def call(self, x):
+        ndense, nnz = self.ndense, self.nnz
+        idx = K.cast(K.maximum(x[..., ndense:ndense+nnz], 0.), 'int32')
+        # empty slots and padded timesteps contribute nothing
+        val = x[..., ndense+nnz:] * K.cast(K.greater(idx, 0), K.floatx())
+        bag = K.sum(K.gather(self.embeddings, idx) * K.expand_dims(val), axis=-2)
+        padded = K.cast(K.all(K.equal(x, -1.), axis=-1, keepdims=True), K.floatx())
+        bag = bag*(1. - padded) - padded
+        return K.concatenate([x[..., :ndense], bag], axis=-1)
+
+    def compute_output_shape(self, input_shape):
+        return tuple(input_shape[:-1]) + (input_shape[-1] - 2*self.nnz + self.nembed,)
+
+    def get_config(self):
+        config = {'nnz': self.nnz, 'nsparse': self.nsparse, 'nembed': self.nembed}
+        config.update(super(SparseEmbedding, self).get_config())
+        return config
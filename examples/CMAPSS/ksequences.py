@@ -0,0 +1,139 @@
+import keras
+import numpy as np
+
+import utils
+
+
+class ArraySequence(keras.utils.Sequence):
+    '''
+    shuffled minibatches of observations of (x, y) as in keras fit with shuffle
+    '''
+    
+    def __init__(self, x, y, batch_size, index=None, shuffle=True, seed=None):
+        self.x, self.y = x, y
+        self.batch_size, self.shuffle = batch_size, shuffle
+        self.order = np.arange(len(x)) if index is None else np.array(index)
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+        
+    def __len__(self):
+        return int(np.ceil(len(self.order) / float(self.batch_size)))
+    
+    def __getitem__(self, idx):
+        batch = np.sort(self.order[idx*self.batch_size:(idx+1)*self.batch_size])
+        return self.x[batch], self.y[batch]
+    
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+            
+            
+def splitarrays(x, y, batch_size, validation_split=.1, seed=None):
+    '''
+    trainseq, validseq = splitarrays(x, y, batch_size)
+    last observations are held out for validation as in keras validation_split
+    '''
+    split_at = int(len(x) * (1. - validation_split))
+    index = np.arange(len(x))
+    trainseq = ArraySequence(x, y, batch_size, index=index[:split_at], seed=seed)
+    validseq = ArraySequence(x, y, batch_size, index=index[split_at:], shuffle=False)
+    return trainseq, validseq
+
+
+class WindowSequence(keras.utils.Sequence):
+    '''
+    shuffled minibatches of windows gathered on the fly from unwindowed (x, y)
+    gives the same windows as utils.getlongver without materializing all of them
+    '''
+    
+    def __init__(self, x, y, winlen, batch_size, index=None, shuffle=True, seed=None):
+        self.x, self.y = x, y
+        self.winlen, self.batch_size, self.shuffle = winlen, batch_size, shuffle
+        if index is None:
+            index = utils.windowindex(x, winlen)
+        self.obsdex, self.startdex = index
+        self.order = np.arange(len(self.obsdex))
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+        
+    def __len__(self):
+        return int(np.ceil(len(self.order) / float(self.batch_size)))
+    
+    def __getitem__(self, idx):
+        batch = self.order[idx*self.batch_size:(idx+1)*self.batch_size]
+        # gather in storage order
+        batch = np.sort(batch)
+        return utils.getwindows(self.x, self.y, self.obsdex[batch], self.startdex[batch], self.winlen)
+    
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+            
+            
+def splitwindows(x, y, winlen, batch_size, validation_split=.1, seed=None):
+    '''
+    trainseq, validseq = splitwindows(x, y, winlen, batch_size)
+    last windows are held out for validation as in keras validation_split
+    '''
+    obsdex, startdex = utils.windowindex(x, winlen)
+    split_at = int(len(obsdex) * (1. - validation_split))
+    trainseq = WindowSequence(x, y, winlen, batch_size, 
+                              index=(obsdex[:split_at], startdex[:split_at]), seed=seed)
+    validseq = WindowSequence(x, y, winlen, batch_size, 
+                              index=(obsdex[split_at:], startdex[split_at:]), shuffle=False)
+    return trainseq, validseq
+
+            
+            
+class BucketSequence(keras.utils.Sequence):
+    '''
+    minibatches of observations with similar lengths, trimmed to the longest in each batch
+    left padding is masked and has zero loss, so trimming only changes the mean over timesteps
+        which sample_weight = trimmed length / nseq puts back to the untrimmed per-sequence loss
+    '''
+    
+    def __init__(self, x, y, batch_size, index=None, shuffle=True, seed=None):
+        self.x, self.y = x, y
+        self.batch_size, self.shuffle = batch_size, shuffle
+        self.nseq = x.shape[1]
+        index = np.arange(len(x)) if index is None else index
+        lengths = utils.seqlengths(x)[index]
+        
+        # consecutive observations in length order form the batches
+        order = np.argsort(lengths, kind='mergesort')
+        self.batches = [index[order[lo:lo+batch_size]] for lo in range(0, len(order), batch_size)]
+        self.batchlens = [np.max(lengths[order[lo:lo+batch_size]]) for lo in range(0, len(order), batch_size)]
+        
+        padded = len(index)*self.nseq - np.sum(lengths)
+        trimmedpadded = sum(len(b)*l for b, l in zip(self.batches, self.batchlens)) - np.sum(lengths)
+        self.paddingremoved = 1. - trimmedpadded / float(padded) if padded > 0 else 0.
+        
+        self.order = np.arange(len(self.batches))
+        self.rng = np.random.RandomState(seed)
+        self.on_epoch_end()
+        
+    def __len__(self):
+        return len(self.batches)
+    
+    def __getitem__(self, idx):
+        batch, batchlen = self.batches[self.order[idx]], self.batchlens[self.order[idx]]
+        batch = np.sort(batch)
+        x, y = self.x[batch][:, -batchlen:, ...], self.y[batch][:, -batchlen:, ...]
+        sample_weight = np.full(len(batch), batchlen / float(self.nseq))
+        return x, y, sample_weight
+    
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.rng.shuffle(self.order)
+            
+            
+def splitbuckets(x, y, batch_size, validation_split=.1, seed=None):
+    '''
+    trainseq, validseq = splitbuckets(x, y, batch_size)
+    last observations are held out for validation as in keras validation_split
+    '''
+    split_at = int(len(x) * (1. - validation_split))
+    index = np.arange(len(x))
+    trainseq = BucketSequence(x, y, batch_size, index=index[:split_at], seed=seed)
+    validseq = BucketSequence(x, y, batch_size, index=index[split_at:], shuffle=False)
+    return trainseq, validseq
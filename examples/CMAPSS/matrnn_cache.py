@@ -0,0 +1,100 @@
+'''
+memoized matrnn_distributional queries for repeated calls on the same entities and horizons
+
+    cache = DistCache(maxsize=256)
+    cache.attach(model)    # MATRNN, cache is emptied whenever model loads new weights
+    q = cache.quantile('storeA-2018-06-01', elapsed, .5, scale, shape)
+
+the caller names the set of entities with key, e.g. (store id, scoring date) for the states loaded for it
+the cache key is (function, key, model version, scalar arguments, input shapes)
+so a hit is one dictionary lookup and does not read the inputs at all
+the caller must not reuse key for different inputs under the same model version
+'''
+import threading
+import collections
+
+import numpy as np
+
+import matrnn_distributional as dist
+
+
+class DistCache(object):
+    '''
+    bounded LRU cache of matrnn_distributional results
+    at most maxsize results and, if given, maxbytes bytes of results are kept
+    cached arrays are read only
+    '''
+
+    def __init__(self, maxsize=128, maxbytes=None, version=None):
+        self.maxsize, self.maxbytes = maxsize, maxbytes
+        self.version = version
+        self.entries = collections.OrderedDict()
+        self.nbytes = 0
+        self.hits, self.misses = 0, 0
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def attach(self, model):
+        '''invalidate with the weights version of model (MATRNN) each time it loads new weights'''
+        model.caches.append(self)
+        self.invalidate(version=(model.weightsfname, model.weightsmtime))
+
+    def invalidate(self, version=None):
+        '''drop all results, e.g. after a model refresh, and key new ones by version'''
+        with self.lock:
+            self.entries.clear()
+            self.nbytes = 0
+            self.version = version
+
+    def getkey(self, name, key, arrays, args):
+        # scalar arguments (p, excess, horizon) are part of the key, array ones only by shape
+        scalars = tuple(float(a) if np.ndim(a) == 0 else None for a in arrays)
+        shapes = tuple(np.shape(a) for a in arrays)
+        return (name, key, self.version, scalars, shapes, args)
+
+    def call(self, name, key, fn, arrays, args=()):
+        '''
+        fn(*(arrays + args)), from cache if computed before for the same key
+        args are hashable arguments such as horizon
+        '''
+        cachekey = self.getkey(name, key, arrays, args)
+        with self.lock:
+            if cachekey in self.entries:
+                self.entries.move_to_end(cachekey)
+                self.hits += 1
+                return self.entries[cachekey]
+            self.misses += 1
+
+        out = fn(*(list(arrays) + list(args)))
+        # numpy scalars from 0-d inputs become 0-d arrays so that they can be frozen too
+        outs = tuple(np.array(o) if np.ndim(o) == 0 else o for o in (out if isinstance(out, tuple) else (out,)))
+        out = outs if isinstance(out, tuple) else outs[0]
+        for o in outs:
+            o.flags.writeable = False
+        nbytes = sum(o.nbytes for o in outs)
+
+        with self.lock:
+            self.entries[cachekey] = out
+            self.nbytes += nbytes
+            while len(self.entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes
+                                                       and len(self.entries) > 1):
+                _, old = self.entries.popitem(last=False)
+                self.nbytes -= sum(o.nbytes for o in (old if isinstance(old, tuple) else (old,)))
+        return out
+
+    def quantile(self, key, elapsed, p, scale, shape):
+        return self.call('quantile', key, dist.quantile, [elapsed, p, scale, shape])
+
+    def logsurv(self, key, elapsed, excess, scale, shape):
+        return self.call('logsurv', key, dist.logsurv, [elapsed, excess, scale, shape])
+
+    def logdiscrete(self, key, elapsed, excess, scale, shape):
+        return self.call('logdiscrete', key, dist.logdiscrete, [elapsed, excess, scale, shape])
+
+    def logdense(self, key, elapsed, excess, scale, shape):
+        return self.call('logdense', key, dist.logdense, [elapsed, excess, scale, shape])
+
+    def discretegrid(self, key, elapsed, scale, shape, horizon):
+        return self.call('discretegrid', key, dist.discretegrid, [elapsed, scale, shape], args=(int(horizon),))
@@ -0,0 +1,79 @@
+'''
+actions minimizing expected cost under the predicted distribution of the excess time Z
+    cost[..., a] = sum_j P(j <= Z < j+1) * loss[j, a] + P(Z >= horizon) * tailloss[a]
+for every entity and event type, e.g. (elapsed, scale, shape) of shape (nobs, neventtypes)
+with elapsed = x[:, -1, :neventtypes] and (scale, shape) = MATRNN.infer(x, laststep=True)
+entities are processed chunksize at a time, memory is about chunksize * (horizon + nactions) floats
+'''
+import numpy as np
+
+import matrnn_distributional as dist
+
+
+def timingloss(horizon, early=1., late=1.):
+    '''
+    loss of acting at time t in 0..horizon-1 if the arrival is in [j, j+1)
+        early * (j - t) if acting before the arrival, late * (t - j) if after
+    returns (loss of shape (horizon, horizon), tailloss of shape (horizon,)) with Z >= horizon taken as Z = horizon
+    '''
+    j = np.arange(horizon)[:, None]
+    t = np.arange(horizon)[None, :]
+    loss = early*np.maximum(j - t, 0) + late*np.maximum(t - j, 0)
+    tailloss = early*(horizon - np.arange(horizon))
+    return loss.astype(float), tailloss.astype(float)
+
+
+def getloss(loss, horizon):
+    '''loss as an array of shape (horizon, nactions), loss may be a function of the grid 0..horizon-1'''
+    if callable(loss):
+        loss = loss(np.arange(horizon))
+    loss = np.asarray(loss, dtype=float)
+    if loss.ndim == 1:
+        loss = loss[:, None]
+    if loss.shape[0] != horizon:
+        raise ValueError('loss has %d rows for horizon %d' % (loss.shape[0], horizon))
+    return loss
+
+
+def expectedcosts(elapsed, scale, shape, loss, horizon, tailloss=0., dtype=None):
+    '''expected cost of each action, shape elapsed.shape + (nactions,)'''
+    loss = getloss(loss, horizon)
+    pmf, cdf = dist.discretegrid(elapsed, scale, shape, horizon, dtype=dtype)
+    return dist.expectedloss(pmf, loss.astype(pmf.dtype), cdf=cdf, tailloss=np.asarray(tailloss, dtype=pmf.dtype))
+
+
+def decide(elapsed, scale, shape, loss, horizon, tailloss=0., chunksize=1024*64, dtype=None, out=None):
+    '''
+    action = argmin over actions of the expected cost, and that cost
+    loss is an array of shape (horizon, nactions) or (horizon,), or a function of the grid 0..horizon-1 returning one
+    tailloss is the cost of each action if there is no arrival within horizon
+    elapsed, scale, shape are broadcast together, they may be memory-mapped
+    out, if given, is a pair of C-contiguous (action, cost) arrays of shape elapsed.shape to write into, e.g. memory-mapped
+    returns (action, cost)
+    '''
+    loss = getloss(loss, horizon)
+    tailloss = np.broadcast_to(np.asarray(tailloss, dtype=float), loss.shape[1:])
+    elapsed, scale, shape = np.broadcast_arrays(elapsed, scale, shape)
+    outshape = elapsed.shape
+    if out is None:
+        out = (np.empty(outshape, dtype=np.int64), np.empty(outshape))
+    action, cost = out[0].reshape(-1), out[1].reshape(-1)
+    elapsed, scale, shape = elapsed.reshape(-1), scale.reshape(-1), shape.reshape(-1)
+
+    for lo in range(0, len(elapsed), chunksize):
+        hi = lo + chunksize
+        costs = expectedcosts(np.asarray(elapsed[lo:hi]), np.asarray(scale[lo:hi]), np.asarray(shape[lo:hi]),
+                              loss, horizon, tailloss=tailloss, dtype=dtype)
+        best = np.argmin(costs, axis=-1)
+        action[lo:hi] = best
+        cost[lo:hi] = costs[np.arange(len(best)), best]
+    return action.reshape(outshape), cost.reshape(outshape)
+
+
+def decidetiming(elapsed, scale, shape, horizon, early=1., late=1., **kwargs):
+    '''
+    time in 0..horizon-1 to act at, minimizing expected timingloss, and its expected cost
+    kwargs are passed to decide
+    '''
+    loss, tailloss = timingloss(horizon, early=early, late=late)
+    return decide(elapsed, scale, shape, loss, horizon, tailloss=tailloss, **kwargs)
@@ -1,10 +1,25 @@
 import numpy as np
 eps = np.finfo(float).eps
 
+def computetype(*arrays):
+    # float64 unless every input array is float32 or float16, then float32
+    # python scalars do not count so that scalar calls stay in float64
+    dtypes = [np.asarray(a).dtype for a in arrays if hasattr(a, 'dtype')]
+    if len(dtypes) > 0 and all(dt in (np.float16, np.float32) for dt in dtypes):
+        return np.dtype(np.float32)
+    return np.dtype(np.float64)
+
+def geteps(dtype):
+    # machine epsilon matching dtype, float16 eps for float16 and so on
+    return np.dtype(dtype).type(np.finfo(dtype).eps)
+
 def gethaz(tse, tte, sc, sh):
-    haz0 = np.power((tse+tte+eps)/sc, sh)
-    haz1 = np.power((tse+tte+1. )/sc, sh)
-    hazc = np.power((tse+eps    )/sc, sh)
+    dtype = computetype(tse, tte, sc, sh)
+    tse, tte, sc, sh = [np.asarray(a, dtype=dtype) for a in (tse, tte, sc, sh)]
+    e = geteps(dtype)
+    haz0 = np.power((tse+tte+e)/sc, sh)
+    haz1 = np.power((tse+tte+1 )/sc, sh)
+    hazc = np.power((tse+e    )/sc, sh)
     return haz0, haz1, hazc
 
 def logsurv(elapsed, excess, scale, shape):
@@ -16,16 +31,57 @@ def logdiscrete(elapsed, excess, scale, shape):
     # for interval censored...
     # exp(-haz0)-exp(-haz1) = exp(-haz1)        (   exp(-haz0-(-haz1)) - 1  )
     # log(...)              = -haz1     +    log(   exp(-haz0-(-haz1)) - 1  )
-    loglike_ivc             = -haz1     + np.log(np.exp(-haz0-(-haz1)) - 1.0)
+    loglike_ivc             = -haz1     + np.log(np.expm1(-haz0-(-haz1)))
     return loglike_ivc - (-hazc)
 
 def logdense(elapsed, excess, scale, shape):
-    tse, tte, sc, sh = elapsed, excess, scale, shape    
+    dtype = computetype(elapsed, excess, scale, shape)
+    tse, tte, sc, sh = [np.asarray(a, dtype=dtype) for a in (elapsed, excess, scale, shape)]
     logsurvval = logsurv(tse, tte, sc, sh)
-    return np.log(sh/sc) + (sh-1)*np.log((tse+tte+eps)/sc) + logsurvval
+    return np.log(sh/sc) + (sh-1)*np.log((tse+tte+geteps(dtype))/sc) + logsurvval
 
 def quantile(elapsed, p, scale, shape):
     _, _, hazc = gethaz(elapsed, 1, scale, shape)
-    haz0 = hazc - np.log(1-p)
-    out = scale * np.power(haz0 , 1/shape) - elapsed
+    haz0 = hazc - np.log1p(-np.asarray(p, dtype=hazc.dtype))
+    out = scale * np.power(haz0 , 1/np.asarray(shape, dtype=hazc.dtype)) - elapsed
+    return out
+
+def mode(elapsed, scale, shape):
+    # unconditional mode is 0 unless shape>1
+    uncmode = scale * np.power(np.maximum(shape-1, 0)/shape, 1/shape)
+    return np.maximum(uncmode - elapsed, 0)
+
+def log1mexp(a):
+    # log(1-exp(-a)) for a>=0, accurate for both small and large a
+    with np.errstate(divide='ignore'):
+        return np.where(a < np.log(2.), np.log(-np.expm1(-a)), np.log1p(-np.exp(-a)))
+
+def hazgrid(elapsed, scale, shape, horizon, dtype=None):
+    # hazards at elapsed+j for j in 0..horizon in a new last axis, computed once
+    # hazgrid[..., 0] is hazc of gethaz, hazgrid[..., j] is haz0 at excess j
+    dtype = np.dtype(np.result_type(elapsed, scale, shape, float) if dtype is None else dtype)
+    tse = np.asarray(elapsed, dtype=dtype)[..., None]
+    sc = np.asarray(scale, dtype=dtype)[..., None]
+    sh = np.asarray(shape, dtype=dtype)[..., None]
+    j = np.arange(horizon+1, dtype=dtype)
+    return np.exp(sh * (np.log(tse+j+geteps(dtype)) - np.log(sc)))
+
+def discretegrid(elapsed, scale, shape, horizon, dtype=None):
+    # pmf[..., j] = P(j <= Z < j+1) as in exp(logdiscrete) at excess j
+    # cdf[..., j] = P(Z < j+1) for j in 0..horizon-1
+    # returned in dtype, computed in at least float32 so that hazards of float16 do not overflow
+    dtype = np.dtype(np.result_type(elapsed, scale, shape, float) if dtype is None else dtype)
+    haz = hazgrid(elapsed, scale, shape, horizon, dtype=np.promote_types(dtype, np.float32))
+    logsurvgrid = haz[..., :1] - haz
+    pmf = np.exp(logsurvgrid[..., :-1] + log1mexp(haz[..., 1:] - haz[..., :-1]))
+    cdf = -np.expm1(logsurvgrid[..., 1:])
+    return pmf.astype(dtype, copy=False), cdf.astype(dtype, copy=False)
+
+def expectedloss(pmf, loss, cdf=None, tailloss=0.):
+    # expected loss sum_j pmf[..., j]*loss[j, ...] for loss of shape (horizon,) or (horizon, nactions)
+    # with cdf, arrivals beyond the horizon (probability 1-cdf[..., -1]) add tailloss
+    out = np.tensordot(pmf, loss, axes=([-1], [0]))
+    if cdf is not None:
+        tail = 1 - cdf[..., -1]
+        out = out + np.reshape(tail, tail.shape + (1,)*(out.ndim-tail.ndim)) * tailloss
     return out
\ No newline at end of file
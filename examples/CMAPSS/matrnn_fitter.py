@@ -16,29 +16,50 @@ from keras.layers.wrappers import TimeDistributed
 from keras.layers import Dense, GRU, LSTM
 from keras.layers.core import Dropout
 
+import utils
 import matrnn_objective as obj
 import matrnn_distributional as dist
-from kcallbacks import SaveValidWeights, TacticalRetreat, EarlyStopping
+from klayers import SparseEmbedding
+from kcallbacks import BatchRetreat, CheckpointManager, TacticalRetreat, EarlyStopping, Telemetry, phase
+from ksequences import splitarrays, splitwindows, splitbuckets
 
 
 class MATRNN(object):
     
-    def __init__(self, modelspec_tuple, jobid, iswtte=False):
+    def __init__(self, modelspec_tuple, jobid, iswtte=False, neventtypes=1, sparse=None):
+        '''
+        one network with shared LSTM layers predicts (scale, shape) for each of neventtypes event types
+        sparse = (nnz, nsparse, nembed) if the last 2*nnz columns of x are sparse covariates
+            as (index, value) slots, embedded by klayers.SparseEmbedding before the first LSTM
+        '''
 
         self.modelspec_tuple = modelspec_tuple
         d, w = modelspec_tuple
         self.weightsfname = 'weights_jobid' + str(jobid) + '_d' + str(d) + 'w' + str(w) + '.h5'
-        self.outputshape = (1, 2)
+        self.outputshape = (neventtypes, 2)
         self.iswtte = iswtte
+        self.sparse = sparse
+        self.checkpoints = None
+        self.weightsmtime = None
+        self.klastmodel = None
+        # matrnn_cache.DistCache instances emptied whenever new weights are loaded
+        self.caches = []
         
 
     def compile(self, nvar, nseq, iniscale, lr=.01, verbose=1):
 
         d, w = self.modelspec_tuple
         nonlin = 'tanh'
+        if np.ndim(iniscale) > 0:
+            # one initial scale per event type
+            iniscale = np.asarray(iniscale, dtype=np.float32).reshape(self.outputshape[:1])
+        self.nvar, self.iniscale = nvar, iniscale
+        self.weightsmtime = None
+        self.klastmodel = None
         
         self.kmodel = Sequential()
-        self.kmodel.add(Masking(mask_value=-1., input_shape=(None, nvar)))
+        for layer in self.getinputlayers(nvar):
+            self.kmodel.add(layer)
 
         for k in range(d):
             self.kmodel.add(LSTM(w, return_sequences=True, dropout=.2))
@@ -48,61 +69,282 @@ class MATRNN(object):
         
         # activation
         self.kmodel.add(Lambda(obj.activation, arguments={"iniscale": iniscale}))
-        loss = obj.ExcessConditionalLoss(iswtte=self.iswtte).loss
+        objective = obj.ExcessConditionalLoss(iswtte=self.iswtte)
+        
+        # loss of each event type is tracked as a metric when there are several
+        nev = self.outputshape[0]
+        metrics = [objective.eventloss(k) for k in range(nev)] if nev > 1 else None
         
         # compile model
-        self.kmodel.compile(loss=loss, optimizer=adam(lr=lr, clipvalue=5.))
-        self.kmodel.summary()
+        self.kmodel.compile(loss=objective.loss, optimizer=adam(lr=lr, clipvalue=5.), metrics=metrics)
+        if verbose>0:
+            self.kmodel.summary()
 
         
-    def fit(self, xtrain, ytrain, iniscale, lr=.01, epochs=100, batch_size=1024, verbose=1):
+    def getinputlayers(self, nvar):
+        '''
+        Masking, preceded by SparseEmbedding if there are sparse covariates
+        '''
+        if self.sparse is None:
+            return [Masking(mask_value=-1., input_shape=(None, nvar))]
+        return [SparseEmbedding(*self.sparse, input_shape=(None, nvar)), Masking(mask_value=-1.)]
+    
+    
+    def fit(self, xtrain, ytrain, iniscale, lr=.01, epochs=100, batch_size=1024, verbose=1, winlen=None, 
+            bucketed=False, nworkers=1, resume=False, telemetry=None, checksize=256, callbacks=None):
+        '''
+        if winlen is given, (xtrain, ytrain) are not windowed 
+            and windows of length winlen are gathered on the fly for each minibatch
+        if bucketed, minibatches group observations of similar length and drop their common left padding
+        if nworkers > 1, each minibatch is split across nworkers processes, see matrnn_parallel.fit
+        if resume, training continues from the latest checkpoint of an earlier run with the same weightsfname
+        if telemetry is a file name, timings, throughput and memory of each epoch and phase are written to it 
+            as json lines, see kcallbacks.Telemetry
+        checks before training run on checksize observations spread over xtrain
+        callbacks are run after the default ones of getcallbacks, e.g. kcallbacks.ASHA
+        returns the keras History of training
+        '''
+        if nworkers > 1:
+            import matrnn_parallel
+            return matrnn_parallel.fit(self, xtrain, ytrain, iniscale, lr=lr, epochs=epochs, batch_size=batch_size,
+                                       verbose=verbose, winlen=winlen, bucketed=bucketed, nworkers=nworkers,
+                                       resume=resume, telemetry=telemetry, checksize=checksize, callbacks=callbacks)
         
         nobs, nseq, nvar = xtrain.shape
         self.compile(lr=lr, 
-                     nvar=xtrain.shape[2], nseq=xtrain.shape[1], 
+                     nvar=xtrain.shape[2], nseq=xtrain.shape[1] if winlen is None else winlen, 
                      iniscale=iniscale)
         
-        if verbose>0:
-            print ('\nchecking if nans in data...')
-            print ('nans in xtrain:\n', np.where(np.isnan(xtrain)))
-            print ('nans in ytrain:\n', np.where(np.isnan(ytrain)))
+        xcheck, ycheck = self.checksample(xtrain, ytrain, checksize)
+        telemetry = self.gettelemetry(telemetry, xcheck, ycheck)
         
-            print ('\nchecking if activation is correct...')
-            atrain = self.kmodel.predict(x=xtrain)
-            print ('activation shape:', atrain.shape)
-
-            print ('\nchecking if loss evaluation is valid...')
-            print ('overall loss:', self.kmodel.evaluate(x=xtrain, y=ytrain, batch_size=batch_size, verbose=1))
+        with phase(telemetry, 'precheck'):
+            self.precheck(xcheck, ycheck, batch_size=batch_size, verbose=verbose)
         
         # callbacks
-        save_val = SaveValidWeights(self.weightsfname)
-        tact_ret = TacticalRetreat(self.weightsfname)
-        earlystop = EarlyStopping(patience=20)
+        callbacks = self.getcallbacks(resume=resume, telemetry=telemetry) + list(callbacks or [])
+        initial_epoch = self.checkpoints.lastepoch() + 1 if resume else 0
         
         t0 = time.time()        
         if verbose>0:
             print ('doing training...')
             
-        self.kmodel.fit(xtrain, ytrain, validation_split = .1, shuffle = True,
-                        batch_size = batch_size,
-                        epochs = epochs, callbacks = [save_val, tact_ret, earlystop],
-                        verbose = 2)
+        with phase(telemetry, 'train'):
+            history = self.trainloop(xtrain, ytrain, epochs, batch_size, winlen, bucketed, callbacks, initial_epoch,
+                                     verbose)
         
         if verbose>0:
             print ('training done in:', time.time()-t0)
+        return history
+            
+            
+    def checksample(self, x, y, checksize=256):
+        '''
+        (x, y) of checksize observations spread evenly over x
+        '''
+        nobs = len(x)
+        checkdex = np.unique(np.linspace(0, nobs-1, min(nobs, checksize)).astype(int))
+        return x[checkdex], y[checkdex]
+    
+    
+    def gettelemetry(self, fname, xcheck, ycheck):
+        '''
+        Telemetry writing to fname, timing the loss within steps on minibatches of (xcheck, ycheck), None if fname is None
+        '''
+        if fname is None:
+            return None
+        loss = obj.ExcessConditionalLoss(iswtte=self.iswtte).loss
+        return Telemetry(fname, loss=loss, losssample=(xcheck, ycheck))
+    
+    
+    def precheck(self, xcheck, ycheck, batch_size=1024, verbose=1):
+        '''
+        check for nans in data and that activation and loss can be evaluated
+        '''
+        if verbose>0:
+            print ('\nchecking if nans in data...')
+            print ('nans in xtrain:\n', np.where(np.isnan(xcheck)))
+            print ('nans in ytrain:\n', np.where(np.isnan(ycheck)))
+        
+            print ('\nchecking if activation is correct...')
+            atrain = self.kmodel.predict(x=xcheck)
+            print ('activation shape:', atrain.shape)
+
+            print ('\nchecking if loss evaluation is valid...')
+            print ('overall loss:', self.eventlosses(xcheck, ycheck, batch_size=batch_size))
+            
+            
+    def trainloop(self, xtrain, ytrain, epochs, batch_size, winlen, bucketed, callbacks, initial_epoch, verbose):
+        '''
+        keras fit of the compiled model on windows, buckets or whole sequences
+        '''
+        if bucketed and winlen is None:
+            trainseq, validseq = splitbuckets(xtrain, ytrain, batch_size, validation_split = .1)
+            if verbose>0:
+                print ('bucketing removed %.1f%% of padding' % (100*trainseq.paddingremoved))
+            return self.kmodel.fit_generator(trainseq, validation_data = validseq,
+                                             epochs = epochs, callbacks = callbacks, initial_epoch = initial_epoch,
+                                             verbose = 2)
+        elif winlen is None and not isinstance(xtrain, np.ndarray):
+            # lazy arrays such as dataset.ShardedArray are read one minibatch at a time
+            trainseq, validseq = splitarrays(xtrain, ytrain, batch_size, validation_split = .1)
+            return self.kmodel.fit_generator(trainseq, validation_data = validseq,
+                                             epochs = epochs, callbacks = callbacks, initial_epoch = initial_epoch,
+                                             verbose = 2)
+        elif winlen is None:
+            return self.kmodel.fit(xtrain, ytrain, validation_split = .1, shuffle = True,
+                                   batch_size = batch_size,
+                                   epochs = epochs, callbacks = callbacks, initial_epoch = initial_epoch,
+                                   verbose = 2)
+        else:
+            trainseq, validseq = splitwindows(xtrain, ytrain, winlen, batch_size, validation_split = .1)
+            if verbose>0:
+                print ('training windows:', len(trainseq.obsdex), 'validation windows:', len(validseq.obsdex))
+            return self.kmodel.fit_generator(trainseq, validation_data = validseq,
+                                             epochs = epochs, callbacks = callbacks, initial_epoch = initial_epoch,
+                                             verbose = 2)
 
         
-    def infer(self, x, verbose=1):
+    def getcallbacks(self, resume=False, telemetry=None):
+        '''
+        rollback of bad minibatches, checkpoints of the last good epochs, 
+        retreat to the last good state on nan loss, and early stopping
+        telemetry (kcallbacks.Telemetry) goes last to see the logs of all others
+        the CheckpointManager is kept as self.checkpoints
+        '''
+        batch_ret = BatchRetreat()
+        checkpoints = CheckpointManager(self.weightsfname, resume=resume)
+        self.checkpoints = checkpoints
+        tact_ret = TacticalRetreat(self.weightsfname, checkpoints=checkpoints)
+        earlystop = EarlyStopping(patience=20)
+        callbacks = [batch_ret, checkpoints, tact_ret, earlystop]
+        if telemetry is not None:
+            callbacks.append(telemetry)
+        return callbacks
+    
+    
+    def eventlosses(self, x, y, batch_size=1024, verbose=1):
+        '''
+        return dict of overall loss and, with several event types, loss_ev<k> of each event type k
+        '''
+        res = self.kmodel.evaluate(x=x, y=y, batch_size=batch_size, verbose=verbose)
+        if not isinstance(res, list):
+            res = [res]
+        return dict(zip(self.kmodel.metrics_names, res))
+    
+    
+    def getlastmodel(self):
+        '''
+        same network as kmodel but only outputs the final timestep
+        '''
+        d, w = self.modelspec_tuple
+        nonlin = 'tanh'
+        
+        klastmodel = Sequential()
+        for layer in self.getinputlayers(self.nvar):
+            klastmodel.add(layer)
+        for k in range(d):
+            klastmodel.add(LSTM(w, return_sequences=(k < d-1)))
+        klastmodel.add(Dense(np.prod(self.outputshape), activation=nonlin))
+        klastmodel.add(Reshape(self.outputshape))
+        klastmodel.add(Lambda(obj.activation, arguments={"iniscale": self.iniscale}))
+        
+        # layers hold the same weights in the same order
+        klastmodel.set_weights(self.kmodel.get_weights())
+        return klastmodel
+    
+    
+    def loadweights(self):
+        '''
+        load weights from file unless they are already loaded
+        '''
+        mtime = os.path.getmtime(self.weightsfname)
+        if mtime != self.weightsmtime:
+            self.kmodel.load_weights(self.weightsfname)
+            self.weightsmtime = mtime
+            self.klastmodel = None
+            for cache in self.caches:
+                cache.invalidate(version=(self.weightsfname, mtime))
+            
+            
+    def infer(self, x, verbose=1, laststep=False, chunksize=1024*16, batch_size=1024, bucketed=False):
+        '''
+        out = infer(x) has shape (nobs, nseq) + outputshape
+        if laststep, out = infer(x, laststep=True) has shape (nobs,) + outputshape
+            and outputs of earlier timesteps are never built
+        x is read and run chunksize rows at a time (e.g. dataset.ShardedArray)
+        if bucketed, chunks group observations of similar length and drop their common left padding
+        '''
         
         # run the model and keep final state...
-        self.kmodel.load_weights(self.weightsfname)
+        self.loadweights()
+        if laststep and self.klastmodel is None:
+            self.klastmodel = self.getlastmodel()
+        kmodel = self.klastmodel if laststep else self.kmodel
         
         if verbose>0: 
             t0 = time.time()
             print ('running model...')
-        out = self.kmodel.predict(x)
+            
+        nobs, nseq = x.shape[:2]
+        out = np.empty(((nobs,) if laststep else (nobs, nseq)) + self.outputshape, dtype=np.float32)
+        if not bucketed:
+            for lo in range(0, nobs, chunksize):
+                out[lo:lo+chunksize] = kmodel.predict(x[lo:lo+chunksize], batch_size=batch_size)
+        else:
+            lengths = utils.seqlengths(x)
+            order = np.argsort(lengths, kind='mergesort')
+            if not laststep:
+                # output at masked steps only sees the zero initial states
+                out[:] = self.kmodel.predict(-np.ones((1, 1, x.shape[2])))[0, 0]
+            ncomputed = 0
+            for lo in range(0, nobs, chunksize):
+                chunk = np.sort(order[lo:lo+chunksize])
+                chunklen = max(1, np.max(lengths[chunk]))
+                pred = kmodel.predict(x[chunk][:, -chunklen:, ...], batch_size=batch_size)
+                if laststep:
+                    out[chunk] = pred
+                else:
+                    out[chunk, -chunklen:] = pred
+                ncomputed += len(chunk)*chunklen
+            if verbose>0:
+                print ('bucketing removed %.1f%% of timesteps' % (100.*(1 - ncomputed / float(nobs*nseq))))
         
         if verbose>0:
             print ('inference done in:', time.time()-t0)
             
-        return out
\ No newline at end of file
+        return out
+    
+    
+    def summarize(self, x, elapsed=None, quantiles=(.25, .5, .75), horizons=(), 
+                  verbose=1, chunksize=1024*16, batch_size=1024):
+        '''
+        summaries of the predicted distribution of next arrival after the last timestep
+        elapsed is tse at the last timestep, defaults to x[:, -1, :neventtypes]
+        returns dict of arrays with shape (nobs,) + outputshape[:-1] + ...
+            scale, shape, mode
+            quantile (..., len(quantiles))
+            survival (..., len(horizons)) probability of no arrival within horizon
+        '''
+        nobs = len(x)
+        nev = self.outputshape[0]
+        summary = {'scale': np.empty((nobs, nev)), 'shape': np.empty((nobs, nev)), 'mode': np.empty((nobs, nev)),
+                   'quantile': np.empty((nobs, nev, len(quantiles))),
+                   'survival': np.empty((nobs, nev, len(horizons)))}
+        
+        for lo in range(0, nobs, chunksize):
+            xchunk = x[lo:lo+chunksize]
+            k = self.infer(xchunk, verbose=verbose, laststep=True, chunksize=chunksize, batch_size=batch_size)
+            sc, sh = k[..., 0].astype(float), k[..., 1].astype(float)
+            tse = xchunk[:, -1, :nev] if elapsed is None else elapsed[lo:lo+chunksize]
+            tse = np.reshape(tse, (len(sc), -1))
+            
+            hi = lo + len(sc)
+            summary['scale'][lo:hi], summary['shape'][lo:hi] = sc, sh
+            summary['mode'][lo:hi] = dist.mode(tse, sc, sh)
+            for j, p in enumerate(quantiles):
+                summary['quantile'][lo:hi, :, j] = dist.quantile(tse, p, sc, sh)
+            for j, h in enumerate(horizons):
+                summary['survival'][lo:hi, :, j] = np.exp(dist.logsurv(tse, h, sc, sh))
+                
+        return summary
@@ -0,0 +1,234 @@
+import time
+
+import numpy as np
+
+
+def sigmoid(x, out=None):
+    out = np.negative(x, out=out)
+    np.exp(out, out=out)
+    out += 1.
+    return np.reciprocal(out, out=out)
+
+
+def hard_sigmoid(x, out=None):
+    # keras.backend.hard_sigmoid
+    out = np.multiply(x, .2, out=out)
+    out += .5
+    return np.clip(out, 0., 1., out=out)
+
+
+recurrent_activations = {'sigmoid': sigmoid, 'hard_sigmoid': hard_sigmoid}
+
+
+class NumpyMATRNN(object):
+    '''
+    forward pass of a trained MATRNN without keras
+    Masking -> LSTM x d -> Dense(tanh) -> Reshape(outputshape) -> matrnn_objective.activation
+    lstms is a list of (kernel, recurrent_kernel, bias) with keras gate order (i, f, c, o)
+    dense is (kernel, bias)
+    embeddings of shape (nsparse+1, nembed) are those of klayers.SparseEmbedding with nnz slots, if any
+    '''
+
+    def __init__(self, lstms, dense, iniscale, maxshape=10., recurrent_activation='hard_sigmoid',
+                 epsilon=1e-7, dtype=np.float32, embeddings=None, nnz=0):
+        self.dtype = np.dtype(dtype)
+        self.lstms = [tuple(np.asarray(wt, dtype=self.dtype) for wt in lstm) for lstm in lstms]
+        self.dense = tuple(np.asarray(wt, dtype=self.dtype) for wt in dense)
+        self.embeddings = None if embeddings is None else np.asarray(embeddings, dtype=self.dtype)
+        self.nnz = int(nnz)
+        # iniscale is a scalar or one per event type
+        self.iniscale = np.asarray(iniscale, dtype=float)
+        self.maxshape, self.epsilon = float(maxshape), float(epsilon)
+        self.recurrent_activation = recurrent_activation
+        self.nvar = self.lstms[0][0].shape[0]
+        if self.embeddings is not None:
+            self.nvar += 2*self.nnz - self.embeddings.shape[1]
+        self.outputshape = (self.dense[0].shape[1] // 2, 2)
+        self.buffers = {}
+
+    @classmethod
+    def fromkeras(cls, model, maxshape=10.):
+        '''from a compiled MATRNN with its weights loaded'''
+        model.loadweights()
+        lstms, dense, embeddings, nnz = [], None, None, 0
+        for layer in model.kmodel.layers:
+            wts = layer.get_weights()
+            if len(wts) == 3:
+                lstms.append(wts)
+                recurrent_activation = layer.recurrent_activation.__name__
+            elif len(wts) == 2:
+                dense = wts
+            elif len(wts) == 1:
+                embeddings, nnz = wts[0], layer.nnz
+        return cls(lstms, dense, model.iniscale, maxshape=maxshape, recurrent_activation=recurrent_activation,
+                   embeddings=embeddings, nnz=nnz)
+
+    @classmethod
+    def fromh5(cls, weightsfname, iniscale, maxshape=10., recurrent_activation='hard_sigmoid', nnz=None):
+        '''
+        from a weights_jobid*_d*w*.h5 file written by keras save_weights
+        iniscale is not in the weights file, recurrent_activation is the keras LSTM default
+        nnz is the number of sparse slots of a model with klayers.SparseEmbedding, not in the weights file either
+        '''
+        import h5py
+        lstms, dense, embeddings = [], None, None
+        with h5py.File(weightsfname, 'r') as f:
+            for name in f.attrs['layer_names']:
+                g = f[name]
+                wts = [np.array(g[wname]) for wname in g.attrs['weight_names']]
+                if len(wts) == 3:
+                    lstms.append(wts)
+                elif len(wts) == 2:
+                    dense = wts
+                elif len(wts) == 1:
+                    embeddings = wts[0]
+        if embeddings is not None and nnz is None:
+            raise ValueError('%s has sparse embeddings, nnz must be given' % weightsfname)
+        return cls(lstms, dense, iniscale, maxshape=maxshape, recurrent_activation=recurrent_activation,
+                   embeddings=embeddings, nnz=nnz or 0)
+
+    def save(self, fname):
+        arrs = {'iniscale': self.iniscale, 'maxshape': self.maxshape, 'epsilon': self.epsilon,
+                'recurrent_activation': self.recurrent_activation,
+                'dense_kernel': self.dense[0], 'dense_bias': self.dense[1]}
+        for k, (kernel, recurrent_kernel, bias) in enumerate(self.lstms):
+            arrs['lstm%d_kernel' % k] = kernel
+            arrs['lstm%d_recurrent_kernel' % k] = recurrent_kernel
+            arrs['lstm%d_bias' % k] = bias
+        if self.embeddings is not None:
+            arrs['embeddings'], arrs['nnz'] = self.embeddings, self.nnz
+        np.savez(fname, **arrs)
+
+    @classmethod
+    def load(cls, fname, dtype=np.float32):
+        arrs = np.load(fname)
+        d = len([key for key in arrs.files if key.endswith('_recurrent_kernel')])
+        lstms = [(arrs['lstm%d_kernel' % k], arrs['lstm%d_recurrent_kernel' % k], arrs['lstm%d_bias' % k])
+                 for k in range(d)]
+        return cls(lstms, (arrs['dense_kernel'], arrs['dense_bias']), arrs['iniscale'],
+                   maxshape=arrs['maxshape'], recurrent_activation=str(arrs['recurrent_activation']),
+                   epsilon=arrs['epsilon'], dtype=dtype,
+                   embeddings=arrs['embeddings'] if 'embeddings' in arrs.files else None,
+                   nnz=arrs['nnz'] if 'nnz' in arrs.files else 0)
+
+    def getbuffers(self, nobs, nseq):
+        '''buffers for a chunk, reused across chunks of the same size'''
+        key = (nobs, nseq)
+        if key not in self.buffers:
+            w = self.lstms[0][1].shape[0]
+            self.buffers = {key: {'z': np.empty((nobs, nseq, 4*w), dtype=self.dtype),
+                                  'zt': np.empty((nobs, 4*w), dtype=self.dtype),
+                                  'seq': [np.empty((nobs, nseq, w), dtype=self.dtype) for j in range(2)],
+                                  'h': np.empty((nobs, w), dtype=self.dtype),
+                                  'c': np.empty((nobs, w), dtype=self.dtype),
+                                  'cnew': np.empty((nobs, w), dtype=self.dtype)}}
+        return self.buffers[key]
+
+    def lstm(self, inp, mask, kernel, recurrent_kernel, bias, buf, seq, laststep):
+        '''
+        one LSTM layer over inp of shape (nobs, nseq, nin) written into seq
+        masked steps keep the states
+        '''
+        nobs, nseq = inp.shape[:2]
+        w = recurrent_kernel.shape[0]
+        recact = recurrent_activations[self.recurrent_activation]
+        z, zt, h, c, cnew = buf['z'], buf['zt'], buf['h'], buf['c'], buf['cnew']
+
+        # input projection of all timesteps in one matmul
+        np.dot(inp.reshape((nobs*nseq, -1)), kernel, out=z.reshape((nobs*nseq, 4*w)))
+        z += bias
+        h[:] = 0
+        c[:] = 0
+        for t in range(nseq):
+            np.dot(h, recurrent_kernel, out=zt)
+            zt += z[:, t, :]
+            i, f, g, o = zt[:, :w], zt[:, w:2*w], zt[:, 2*w:3*w], zt[:, 3*w:]
+            recact(i, out=i)
+            recact(f, out=f)
+            np.tanh(g, out=g)
+            recact(o, out=o)
+            # c = f*c + i*g, h = o*tanh(c)
+            np.multiply(f, c, out=cnew)
+            i *= g
+            cnew += i
+            np.tanh(cnew, out=g)
+            g *= o
+            np.copyto(c, cnew, where=mask[:, t, None])
+            np.copyto(h, g, where=mask[:, t, None])
+            if not laststep:
+                seq[:, t, :] = h
+        return h if laststep else seq
+
+    def activation(self, a):
+        '''matrnn_objective.activation in numpy'''
+        out = np.empty_like(a)
+        out[..., 0] = self.iniscale*np.exp(a[..., 0])
+        sh = a[..., 1]
+        if self.maxshape > 1.:
+            sh = sh - np.log(self.maxshape - 1.)
+        out[..., 1] = self.maxshape*np.clip(sigmoid(sh), self.epsilon, 1 - self.epsilon)
+        return out
+
+    def embed(self, x):
+        '''klayers.SparseEmbedding in numpy'''
+        ndense, nnz = x.shape[-1] - 2*self.nnz, self.nnz
+        idx = np.maximum(x[..., ndense:ndense+nnz], 0).astype(np.intp)
+        val = np.where(idx > 0, x[..., ndense+nnz:], 0)
+        bag = np.einsum('...k,...ke->...e', val, self.embeddings[idx])
+        bag[np.all(x == -1., axis=-1)] = -1.
+        return np.concatenate([x[..., :ndense], bag], axis=-1)
+
+    def forward(self, x, laststep=False):
+        nobs, nseq, nvar = x.shape
+        x = np.asarray(x, dtype=self.dtype)
+        mask = np.any(x != -1., axis=-1)
+        buf = self.getbuffers(nobs, nseq)
+
+        # layers alternate between two sequence buffers
+        out = x if self.embeddings is None else self.embed(x)
+        for k, (kernel, recurrent_kernel, bias) in enumerate(self.lstms):
+            islast = laststep and k == len(self.lstms)-1
+            out = self.lstm(out, mask, kernel, recurrent_kernel, bias, buf, buf['seq'][k % 2], islast)
+        kernel, bias = self.dense
+        a = np.tanh(np.dot(out, kernel) + bias)
+        return self.activation(a.reshape(a.shape[:-1] + self.outputshape))
+
+    def infer(self, x, laststep=False, chunksize=1024*4, verbose=1):
+        '''
+        same as MATRNN.infer, x is read and run chunksize rows at a time
+        '''
+        if verbose>0:
+            t0 = time.time()
+            print ('running model...')
+        nobs, nseq = x.shape[:2]
+        out = np.empty(((nobs,) if laststep else (nobs, nseq)) + self.outputshape, dtype=self.dtype)
+        for lo in range(0, nobs, chunksize):
+            out[lo:lo+chunksize] = self.forward(x[lo:lo+chunksize], laststep=laststep)
+        if verbose>0:
+            print ('inference done in:', time.time()-t0)
+        return out
+
+
+def main(args=None):
+    '''
+    export a keras weights file for serving without keras
+        python matrnn_numpy.py weights_jobidmatrnn_d2w64.h5 --iniscale 206.3 --out matrnn_d2w64.npz
+    '''
+    import argparse
+    parser = argparse.ArgumentParser(description=main.__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('weightsfname')
+    parser.add_argument('--iniscale', type=float, nargs='+', required=True, help='one per event type or one for all')
+    parser.add_argument('--maxshape', type=float, default=10.)
+    parser.add_argument('--recurrent_activation', default='hard_sigmoid', choices=sorted(recurrent_activations))
+    parser.add_argument('--nnz', type=int, default=None, help='sparse slots per timestep if the model has sparse embeddings')
+    parser.add_argument('--out', required=True)
+    args = parser.parse_args(args)
+    iniscale = args.iniscale[0] if len(args.iniscale) == 1 else args.iniscale
+    model = NumpyMATRNN.fromh5(args.weightsfname, iniscale, maxshape=args.maxshape,
+                               recurrent_activation=args.recurrent_activation, nnz=args.nnz)
+    model.save(args.out)
+    print ('exported', len(model.lstms), 'LSTM layers with outputshape', model.outputshape, 'to', args.out)
+
+
+if __name__ == '__main__':
+    main()
@@ -2,9 +2,18 @@ import numpy as np
 import keras.backend as K
 
 
+def geteps():
+    '''
+    K.epsilon() unless it is below the resolution of K.floatx(), i.e. float16
+    '''
+    if K.floatx() == 'float16':
+        return max(K.epsilon(), float(np.finfo(np.float16).eps))
+    return K.epsilon()
+
+
 def single_activation(sc, sh, iniscale, maxshape = 10.):
     
-    eps = K.epsilon()
+    eps = geteps()
     sc = iniscale*K.exp(sc)
     
     if maxshape>1.: 
@@ -33,7 +42,7 @@ def activation(ypred, iniscale, maxshape = 10.):
 
 def single_loglike(tse, tte, sc, sh, iswtte=False):
     
-    eps  = K.epsilon()
+    eps  = geteps()
     haz0 = K.pow((tse+tte+eps)/sc, sh)
     haz1 = K.pow((tse+tte+1. )/sc, sh)
     hazc = K.pow((tse+eps    )/sc, sh)
@@ -59,6 +68,47 @@ def single_loglike(tse, tte, sc, sh, iswtte=False):
     return (loglike_ivc, loglike_rc)
 
 
+def log1mexp(a):
+    '''
+    return log(1-exp(-a)) for a>0, accurate for both small and large a
+    https://cran.r-project.org/web/packages/Rmpfr/vignettes/log1mexp-note.pdf
+    '''
+    # both branches are evaluated, each gets its input clamped to its own range
+    # so that the branch not selected cannot give log(0) and nan gradients
+    # 4*tiny so that a/2 is not subnormal
+    a = K.maximum(a, 4*np.finfo(K.floatx()).tiny)
+    asmall = K.minimum(a, np.log(2.))
+    alarge = K.maximum(a, np.log(2.))
+    # small a: 1-exp(-a) = 2t/(1+t) with t = tanh(a/2), without the cancellation of 1-exp(-a)
+    t = K.tanh(asmall/2.)
+    return K.switch(K.less(a, np.log(2.)), 
+                    K.log(2.*t/(1.+t)), 
+                    K.log(1.-K.exp(-alarge)))
+
+
+def fused_loglike(tse, tte, unc, purchstatus, sc, sh, iswtte=False):
+    '''return masked loglikelihood, same as combining single_loglike wherever that is finite'''
+    
+    eps  = geteps()
+    if iswtte:
+        elapsed = 0.
+        hazc = 0.
+    else:
+        elapsed = tse
+        hazc = K.pow((tse+eps)/sc, sh)
+    haz0 = K.pow((elapsed+tte+eps)/sc, sh)
+    haz1 = K.pow((elapsed+tte+1. )/sc, sh)
+    
+    # right censored is log(S(tse+tte))-log(S(tse))
+    # interval censored adds log(1-exp(-haz1+haz0)) to it
+    observed = K.greater(purchstatus, 0.)
+    dhaz = K.switch(observed, haz1-haz0, K.ones_like(haz0))
+    loglike = (hazc-haz0) + unc*log1mexp(dhaz)
+    
+    # masked entries are replaced rather than multiplied so that they cannot give nan
+    return purchstatus*K.switch(observed, loglike, K.zeros_like(loglike))
+
+
 class ExcessConditionalLoss(object):
     '''
     method 'loss' takes (ytrue, ypred)
@@ -66,10 +116,11 @@ class ExcessConditionalLoss(object):
         ytrue has 3 while ypred has 2
     '''
     
-    def __init__(self, iswtte=False):
+    def __init__(self, iswtte=False, fused=True):
         self.iswtte = iswtte
+        self.fused = fused
         
-    def loss(self, ytrue, ypred):
+    def eventloglike(self, ytrue, ypred):
         
         # this is ytrue...
         # y[..., {0, 1, 2, 3}] is {tse, tte, uncensored, purchstatus}        
@@ -81,11 +132,27 @@ class ExcessConditionalLoss(object):
         sc = ypred[..., 0]
         sh = ypred[..., 1]
         
-        llivc, llrc = single_loglike(tse, tte, sc, sh, iswtte=self.iswtte)
-        loglike = unc*llivc + (1-unc)*llrc
-        loglike = purchstatus*loglike
+        if self.fused:
+            loglike = fused_loglike(tse, tte, unc, purchstatus, sc, sh, iswtte=self.iswtte)
+        else:
+            llivc, llrc = single_loglike(tse, tte, sc, sh, iswtte=self.iswtte)
+            loglike = unc*llivc + (1-unc)*llrc
+            loglike = purchstatus*loglike
+        
+        return loglike
+    
+    def loss(self, ytrue, ypred):
         
         # marginalize by event type
-        loglike = K.sum(loglike, axis=-1)
+        loglike = K.sum(self.eventloglike(ytrue, ypred), axis=-1)
             
-        return -1.*loglike
\ No newline at end of file
+        return -1.*loglike
+    
+    def eventloss(self, k):
+        '''
+        return loss of event type k alone, e.g. as a keras metric
+        '''
+        def loss(ytrue, ypred):
+            return -1.*self.eventloglike(ytrue, ypred)[..., k]
+        loss.__name__ = 'loss_ev%d' % k
+        return loss
\ No newline at end of file
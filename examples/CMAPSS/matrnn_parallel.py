@@ -0,0 +1,261 @@
+'''
+data-parallel training of MATRNN on one machine
+
+each global minibatch is split across nworkers forked processes
+workers compute gradients of their part and write them to shared memory
+the coordinator sums them, applies the optimizer update and runs the callbacks
+so checkpoints, TacticalRetreat and EarlyStopping behave as in MATRNN.fit
+'''
+import time
+import ctypes
+import threading
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+import keras
+import keras.backend as K
+
+import matrnn_objective as obj
+from ksequences import splitarrays, splitwindows, splitbuckets
+
+
+# commands from coordinator to workers
+STOP, TRAIN, EVAL, EPOCHEND = 0, 1, 2, 3
+
+
+def getlossfns(model):
+    '''
+    gradfn, lossfn taking [x, y, sample_weight, learning_phase]
+    loss is the mean over observations of sample_weight * loss averaged over timesteps, as in keras
+    '''
+    kmodel = model.kmodel
+    ytrue = K.placeholder(ndim=4)
+    sample_weight = K.placeholder(ndim=1)
+    objective = obj.ExcessConditionalLoss(iswtte=model.iswtte)
+    loss = K.mean(K.mean(objective.loss(ytrue, kmodel.output), axis=1) * sample_weight)
+    inputs = [kmodel.input, ytrue, sample_weight, K.learning_phase()]
+    # embeddings of sparse covariates have IndexedSlices gradients, made dense to share them
+    grads = [tf.convert_to_tensor(g) for g in K.gradients(loss, kmodel.trainable_weights)]
+    gradfn = K.function(inputs, [loss] + grads)
+    lossfn = K.function(inputs, [loss])
+    return gradfn, lossfn
+
+
+def getapplyfn(kmodel):
+    '''
+    applyfn(grads) runs the optimizer update of kmodel with given gradients
+    '''
+    params = kmodel.trainable_weights
+    gradsin = [K.placeholder(shape=K.int_shape(p)) for p in params]
+    optimizer = kmodel.optimizer
+    # gradients come from the workers instead of K.gradients
+    optimizer.get_gradients = lambda loss, params: gradsin
+    updates = optimizer.get_updates(loss=None, params=params)
+    return K.function(gradsin, [], updates=updates)
+
+
+class SharedState(object):
+    '''
+    buffers in shared memory, created before forking
+    weights: flat weights published by the coordinator
+    grads: (nworkers, nparams) sum of gradients over each worker's observations
+    losses, counts: (nworkers,) sum of losses and number of observations of each worker
+    ctrl: (command, step)
+    '''
+
+    def __init__(self, ctx, nparams, nworkers):
+        self.weights = np.frombuffer(ctx.RawArray(ctypes.c_double, nparams))
+        self.grads = np.frombuffer(ctx.RawArray(ctypes.c_double, nworkers*nparams)).reshape((nworkers, nparams))
+        self.losses = np.frombuffer(ctx.RawArray(ctypes.c_double, nworkers))
+        self.counts = np.frombuffer(ctx.RawArray(ctypes.c_double, nworkers))
+        self.ctrl = np.frombuffer(ctx.RawArray(ctypes.c_int64, 2), dtype=np.int64)
+        self.start = ctx.Barrier(nworkers+1)
+        self.done = ctx.Barrier(nworkers+1)
+
+    def abort(self):
+        self.start.abort()
+        self.done.abort()
+
+
+def flatten(arrs):
+    return np.concatenate([np.ravel(a) for a in arrs])
+
+
+def unflatten(flat, shapes):
+    bounds = np.cumsum([0] + [int(np.prod(s)) for s in shapes])
+    return [flat[lo:hi].reshape(s) for lo, hi, s in zip(bounds[:-1], bounds[1:], shapes)]
+
+
+def getbatch(seq, idx):
+    '''(x, y, sample_weight) of batch idx of a ksequences sequence'''
+    batch = seq[idx]
+    if len(batch) == 2:
+        return batch + (np.ones(len(batch[0])),)
+    return batch
+
+
+def worker(rank, nworkers, model, compileargs, trainseq, validseq, shared, threads):
+    '''
+    global step k runs batch k*nworkers + rank of the sequence
+    '''
+    try:
+        K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                       inter_op_parallelism_threads=1)))
+        model.compile(verbose=0, **compileargs)
+        gradfn, lossfn = getlossfns(model)
+        params = model.kmodel.trainable_weights
+        shapes = [K.int_shape(p) for p in params]
+
+        while True:
+            shared.start.wait()
+            command, step = shared.ctrl
+            if command == STOP:
+                shared.done.wait()
+                break
+            if command == EPOCHEND:
+                trainseq.on_epoch_end()
+                shared.done.wait()
+                continue
+
+            seq = trainseq if command == TRAIN else validseq
+            idx = step*nworkers + rank
+            shared.losses[rank], shared.counts[rank] = 0., 0.
+            if command == TRAIN:
+                shared.grads[rank] = 0.
+            if idx < len(seq):
+                x, y, sample_weight = getbatch(seq, idx)
+                n = len(x)
+                K.batch_set_value(list(zip(params, unflatten(shared.weights, shapes))))
+                if command == TRAIN:
+                    res = gradfn([x, y, sample_weight, 1])
+                    shared.grads[rank] = n*flatten(res[1:])
+                else:
+                    res = lossfn([x, y, sample_weight, 0])
+                shared.losses[rank], shared.counts[rank] = n*res[0], n
+            shared.done.wait()
+    except Exception:
+        shared.abort()
+        raise
+
+
+def runstep(shared, command, step=0):
+    '''release workers for one command and wait for all of them'''
+    shared.ctrl[:] = command, step
+    try:
+        shared.start.wait()
+        shared.done.wait()
+    except threading.BrokenBarrierError:
+        raise RuntimeError('a training worker failed, see its traceback above')
+
+
+def fit(model, xtrain, ytrain, iniscale, lr=.01, epochs=100, batch_size=1024, verbose=1, winlen=None,
+        bucketed=False, nworkers=None, threads=None, resume=False, telemetry=None, checksize=256, callbacks=None):
+    '''
+    same as MATRNN.fit with each minibatch of batch_size split across nworkers processes
+    threads is the number of tensorflow threads of each worker, defaults to cpu_count // nworkers
+    workers are forked before any tensorflow session exists in this process
+    telemetry, checksize and callbacks are as in MATRNN.fit, feed and compute times of a minibatch are seen from the coordinator
+    returns the keras History of training
+    '''
+    ctx = multiprocessing.get_context('fork')
+    nworkers = ctx.cpu_count() if nworkers is None else nworkers
+    threads = max(1, ctx.cpu_count() // nworkers) if threads is None else threads
+    wbatch = int(np.ceil(batch_size / float(nworkers)))
+
+    if bucketed and winlen is None:
+        trainseq, validseq = splitbuckets(xtrain, ytrain, wbatch, validation_split = .1)
+    elif winlen is None:
+        trainseq, validseq = splitarrays(xtrain, ytrain, wbatch, validation_split = .1)
+    else:
+        trainseq, validseq = splitwindows(xtrain, ytrain, winlen, wbatch, validation_split = .1)
+    ntrain = int(np.ceil(len(trainseq) / float(nworkers)))
+    nvalid = int(np.ceil(len(validseq) / float(nworkers)))
+
+    # parameter count without building a graph in this process
+    d, w = model.modelspec_tuple
+    nvar = xtrain.shape[2]
+    nin = [nvar] + [w]*(d-1)
+    nparams = 0
+    if model.sparse is not None:
+        nnz, nsparse, nembed = model.sparse
+        nin[0] = nvar - 2*nnz + nembed
+        nparams += (nsparse + 1)*nembed
+    nparams += sum(4*w*(k + w + 1) for k in nin) + (w + 1)*int(np.prod(model.outputshape))
+
+    shared = SharedState(ctx, nparams, nworkers)
+    compileargs = {'nvar': nvar, 'nseq': xtrain.shape[1] if winlen is None else winlen,
+                   'iniscale': iniscale, 'lr': lr}
+    procs = [ctx.Process(target=worker, args=(rank, nworkers, model, compileargs, trainseq, validseq, shared, threads))
+             for rank in range(nworkers)]
+    for p in procs:
+        p.start()
+
+    try:
+        model.compile(verbose=verbose, **compileargs)
+        kmodel = model.kmodel
+        applyfn = getapplyfn(kmodel)
+        shapes = [K.int_shape(p) for p in kmodel.trainable_weights]
+        clipvalue = getattr(kmodel.optimizer, 'clipvalue', None)
+
+        telemetry = model.gettelemetry(telemetry, *model.checksample(xtrain, ytrain, checksize))
+        callbacklist = model.getcallbacks(resume=resume, telemetry=telemetry) + list(callbacks or [])
+        initial_epoch = model.checkpoints.lastepoch() + 1 if resume else 0
+        history = keras.callbacks.History()
+        callbacks = keras.callbacks.CallbackList(callbacklist + [history])
+        callbacks.set_model(kmodel)
+        kmodel.stop_training = False
+
+        t0 = time.time()
+        if verbose>0:
+            print ('doing training on', nworkers, 'workers with', threads, 'threads each...')
+        callbacks.on_train_begin()
+        for epoch in range(initial_epoch, epochs):
+            te = time.time()
+            callbacks.on_epoch_begin(epoch)
+            trainloss, trainn = 0., 0.
+            for step in range(ntrain):
+                callbacks.on_batch_begin(step, {'batch': step})
+                shared.weights[:] = flatten(K.batch_get_value(kmodel.trainable_weights))
+                runstep(shared, TRAIN, step)
+                n = np.sum(shared.counts)
+                grads = np.sum(shared.grads, axis=0) / n
+                batchloss = np.sum(shared.losses) / n
+                if not np.all(np.isfinite(grads)):
+                    # skip the update, BatchRetreat sees the nan loss
+                    batchloss = np.nan
+                else:
+                    if clipvalue is not None:
+                        grads = np.clip(grads, -clipvalue, clipvalue)
+                    applyfn(unflatten(grads.astype(K.floatx()), shapes))
+
+                trainloss, trainn = trainloss + batchloss*n, trainn + n
+                callbacks.on_batch_end(step, {'batch': step, 'size': n, 'loss': batchloss})
+                if kmodel.stop_training:
+                    break
+
+            # validation with weights after the epoch
+            shared.weights[:] = flatten(K.batch_get_value(kmodel.trainable_weights))
+            validloss, validn = 0., 0.
+            for step in range(nvalid):
+                runstep(shared, EVAL, step)
+                validloss, validn = validloss + np.sum(shared.losses), validn + np.sum(shared.counts)
+            runstep(shared, EPOCHEND)
+
+            logs = {'loss': trainloss / trainn, 'val_loss': validloss / validn if validn > 0 else np.nan}
+            callbacks.on_epoch_end(epoch, logs)
+            if verbose>0:
+                print ('Epoch %d/%d - %ds - loss: %.4f - val_loss: %.4f'
+                       % (epoch+1, epochs, time.time()-te, logs['loss'], logs['val_loss']))
+            if kmodel.stop_training:
+                break
+        callbacks.on_train_end()
+        runstep(shared, STOP)
+    finally:
+        shared.abort()
+        for p in procs:
+            p.join()
+
+    if verbose>0:
+        print ('training done in:', time.time()-t0)
+    return history
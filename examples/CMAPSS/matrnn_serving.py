@@ -0,0 +1,184 @@
+import time
+
+import numpy as np
+
+
+class StateStore(object):
+    '''
+    per-entity recurrent states and running (tse, purchstatus) counters keyed by entity id
+    states.shape = (nentities, d, 2, w) holding (hidden, cell) of each LSTM layer
+    tse.shape = purchstatus.shape = (nentities, neventtypes)
+    ids are kept sorted so lookups are a searchsorted
+    iddtype of ids, e.g. np.int64 or 'U16', is taken from the first ids added if None
+    '''
+
+    def __init__(self, d, w, neventtypes=1, dtype=np.float32, iddtype=None):
+        self.d, self.w, self.neventtypes = d, w, neventtypes
+        self.ids = np.empty(0, dtype=object if iddtype is None else iddtype)
+        self.states = np.zeros((0, d, 2, w), dtype=dtype)
+        self.tse = np.zeros((0, neventtypes), dtype=dtype)
+        self.purchstatus = np.zeros((0, neventtypes), dtype=dtype)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def lookup(self, ids, create=False):
+        '''
+        return positions of ids in the store
+        unknown ids raise KeyError unless create, then they start with zero states and counters
+        '''
+        ids = np.asarray(ids)
+        pos = np.searchsorted(self.ids, ids)
+        if len(self.ids) > 0:
+            found = self.ids[np.minimum(pos, len(self.ids)-1)] == ids
+        else:
+            found = np.zeros(len(ids), dtype=bool)
+        if not np.all(found):
+            if not create:
+                raise KeyError('unknown entity ids: %s' % ids[~found][:10])
+            self.add(np.unique(ids[~found]))
+            pos = np.searchsorted(self.ids, ids)
+        return pos
+
+    def add(self, newids):
+        '''add newids (unique, not in store) with zero states and counters'''
+        newids = np.asarray(newids)
+        if len(np.unique(newids)) != len(newids):
+            raise ValueError('duplicate entity ids')
+        if len(self.ids) > 0:
+            pos = np.minimum(np.searchsorted(self.ids, newids), len(self.ids)-1)
+            if np.any(self.ids[pos] == newids):
+                raise ValueError('entity ids already in store: %s' % newids[self.ids[pos] == newids][:10])
+        # concatenate promotes to a dtype holding both old and new ids, e.g. longer strings
+        if len(self.ids) > 0:
+            ids = np.concatenate([self.ids, newids])
+        else:
+            ids = newids if self.ids.dtype == object else newids.astype(self.ids.dtype)
+        order = np.argsort(ids, kind='mergesort')
+        n = len(newids)
+        self.ids = ids[order]
+        self.states = np.concatenate([self.states, np.zeros((n,) + self.states.shape[1:], self.states.dtype)])[order]
+        self.tse = np.concatenate([self.tse, np.zeros((n,) + self.tse.shape[1:], self.tse.dtype)])[order]
+        self.purchstatus = np.concatenate([self.purchstatus, np.zeros((n,) + self.purchstatus.shape[1:],
+                                                                      self.purchstatus.dtype)])[order]
+
+    def save(self, fname):
+        np.savez(fname, ids=self.ids, states=self.states, tse=self.tse, purchstatus=self.purchstatus)
+
+    @classmethod
+    def load(cls, fname):
+        arrs = np.load(fname)
+        nent, d, _, w = arrs['states'].shape
+        store = cls(d, w, neventtypes=arrs['tse'].shape[1], dtype=arrs['states'].dtype)
+        store.ids, store.states = arrs['ids'], arrs['states']
+        store.tse, store.purchstatus = arrs['tse'], arrs['purchstatus']
+        return store
+
+
+class StatefulScorer(object):
+    '''
+    keep LSTM states per entity so that one new timestep costs one recurrent step
+    instead of re-running the whole window
+    model is a compiled MATRNN with its weights, x has the same layout as utils.split
+        i.e. x[..., :] = (tse, purchstatus, covariates...)
+    '''
+
+    def __init__(self, model, store=None):
+        self.model = model
+        d, w = model.modelspec_tuple
+        self.store = StateStore(d, w, neventtypes=model.outputshape[0]) if store is None else store
+        self.kstepmodel = self.getstepmodel()
+
+    def getstepmodel(self):
+        '''
+        same network as model.kmodel taking and returning the LSTM states
+        '''
+        # keras only for scoring, so that StateStore works without it
+        from keras.models import Model
+        from keras.layers import Input, Dense, Lambda, LSTM
+        from keras.layers.core import Masking, Reshape
+        from keras.layers.wrappers import TimeDistributed
+
+        import matrnn_objective as obj
+        from klayers import SparseEmbedding
+
+        d, w = self.model.modelspec_tuple
+        nonlin = 'tanh'
+
+        xin = Input(shape=(None, self.model.nvar))
+        statesin = [Input(shape=(w,)) for k in range(2*d)]
+
+        out = xin if self.model.sparse is None else SparseEmbedding(*self.model.sparse)(xin)
+        out = Masking(mask_value=-1.)(out)
+        statesout = []
+        for k in range(d):
+            out, hk, ck = LSTM(w, return_sequences=True, return_state=True)(out, initial_state=statesin[2*k:2*k+2])
+            statesout += [hk, ck]
+        out = Dense(np.prod(self.model.outputshape), activation=nonlin)(out)
+        out = TimeDistributed(Reshape(self.model.outputshape))(out)
+        out = Lambda(obj.activation, arguments={"iniscale": self.model.iniscale})(out)
+        kstepmodel = Model(inputs=[xin] + statesin, outputs=[out] + statesout)
+
+        # copy weights layer by layer, skipping layers without weights
+        self.model.loadweights()
+        src = [l for l in self.model.kmodel.layers if len(l.get_weights()) > 0]
+        dst = [l for l in kstepmodel.layers if len(l.get_weights()) > 0]
+        for lsrc, ldst in zip(src, dst):
+            ldst.set_weights(lsrc.get_weights())
+        return kstepmodel
+
+    def run(self, pos, x, batch_size=1024):
+        '''run x from stored states at pos, store new states and return last step parameters'''
+        d, w = self.model.modelspec_tuple
+        statesin = [self.store.states[pos, k, j, :] for k in range(d) for j in range(2)]
+        res = self.kstepmodel.predict([x] + statesin, batch_size=batch_size)
+        for k in range(d):
+            for j in range(2):
+                self.store.states[pos, k, j, :] = res[1 + 2*k + j]
+        return res[0][:, -1, ...]
+
+    def warmup(self, ids, x, batch_size=1024, verbose=1):
+        '''
+        run windows x of shape (nentities, nseq, nvar) from zero states
+        and keep final states and counters for ids
+        returns last step parameters
+        '''
+        if verbose>0:
+            t0 = time.time()
+        pos = self.store.lookup(ids, create=True)
+        self.store.states[pos] = 0
+        out = self.run(pos, x, batch_size=batch_size)
+        nev = self.store.neventtypes
+        self.store.tse[pos] = x[:, -1, :nev]
+        self.store.purchstatus[pos] = x[:, -1, nev:2*nev]
+        if verbose>0:
+            print ('warmup of', len(ids), 'entities done in:', time.time()-t0)
+        return out
+
+    def step(self, ids, xnew, batch_size=1024):
+        '''
+        advance ids by xnew of shape (nentities, nvar) or (nentities, nnew, nvar)
+        rows of xnew that are all -1 are masked and leave states unchanged
+        returns last step parameters
+        '''
+        xnew = np.asarray(xnew)
+        if xnew.ndim == 2:
+            xnew = xnew[:, None, :]
+        pos = self.store.lookup(ids, create=True)
+        return self.run(pos, xnew, batch_size=batch_size)
+
+    def advance(self, ids, indicators, covariates, batch_size=1024):
+        '''
+        advance ids by one timestep given event indicators of shape (nentities, neventtypes)
+        and scaled covariates of shape (nentities, ncov)
+        tse and purchstatus counters are updated as in TimeSeriesTransforms
+        returns last step parameters
+        '''
+        pos = self.store.lookup(ids, create=True)
+        indicators = np.asarray(indicators) != 0
+        tse = np.where(indicators, 0, self.store.tse[pos] + 1)
+        purchstatus = np.maximum(self.store.purchstatus[pos], indicators)
+        self.store.tse[pos], self.store.purchstatus[pos] = tse, purchstatus
+
+        xnew = np.concatenate([tse, purchstatus, covariates], axis=-1)[:, None, :]
+        return self.run(pos, xnew, batch_size=batch_size)
@@ -0,0 +1,69 @@
+'''
+Monte Carlo counts of arrivals within horizons by chaining draws of the excess time Z
+    z = matrnn_distributional.quantile(elapsed, u, scale, shape) with u uniform on [0, 1)
+after each simulated arrival elapsed (tse) restarts from 0 while (scale, shape) stay as predicted
+arrival times are continuous, an arrival at time z counts towards horizon h if z < h
+    so P(count >= 1 within h) is cdf[..., h-1] of matrnn_distributional.discretegrid
+'''
+import numpy as np
+
+import matrnn_distributional as dist
+
+
+def samplecounts(elapsed, scale, shape, horizons, nsamples, maxcount, rng):
+    '''
+    counts of shape (n, nsamples, len(horizons)) for n entities given as 1-d arrays
+    paths stop after maxcount arrivals or once past the last horizon
+    '''
+    horizons = np.asarray(horizons, dtype=float)
+    hmax = np.max(horizons)
+    n = len(elapsed)
+    counts = np.zeros((n*nsamples, len(horizons)), dtype=np.int64)
+
+    # state of paths still running, compacted after every arrival
+    active = np.arange(n*nsamples)
+    tse = np.repeat(np.asarray(elapsed, dtype=float), nsamples)
+    sc = np.repeat(np.asarray(scale, dtype=float), nsamples)
+    sh = np.repeat(np.asarray(shape, dtype=float), nsamples)
+    t = np.zeros(n*nsamples)
+    for k in range(maxcount):
+        if len(active) == 0:
+            break
+        t = t + dist.quantile(tse, rng.random_sample(len(active)), sc, sh)
+        counts[active] += t[:, None] < horizons
+        keep = t < hmax
+        active, t, sc, sh = active[keep], t[keep], sc[keep], sh[keep]
+        # tse restarts at each arrival
+        tse = np.zeros(len(active))
+    return counts.reshape((n, nsamples, len(horizons)))
+
+
+def countdist(elapsed, scale, shape, horizons, nsamples=1000, maxcount=50, chunksize=1024, seed=0):
+    '''
+    pmf of the number of arrivals within each horizon
+    elapsed, scale, shape have the same shape, e.g. (nobs, neventtypes) from MATRNN.summarize
+    returns array of shape elapsed.shape + (len(horizons), maxcount+1), the last bin is maxcount or more
+    entities are simulated chunksize at a time so memory is bounded by chunksize*nsamples per horizon
+    chunk k uses the random stream seeded by (seed, k), results are reproducible for a given chunksize
+    '''
+    elapsed, scale, shape = np.broadcast_arrays(elapsed, scale, shape)
+    outshape = elapsed.shape
+    elapsed, scale, shape = elapsed.ravel(), scale.ravel(), shape.ravel()
+    horizons = np.asarray(horizons, dtype=float)
+
+    out = np.zeros((len(elapsed), len(horizons), maxcount+1))
+    for k, lo in enumerate(range(0, len(elapsed), chunksize)):
+        rng = np.random.RandomState([seed, k])
+        counts = samplecounts(elapsed[lo:lo+chunksize], scale[lo:lo+chunksize], shape[lo:lo+chunksize],
+                              horizons, nsamples, maxcount, rng)
+        # histogram over samples of each (entity, horizon)
+        n = counts.shape[0]
+        flat = (np.arange(n)[:, None, None]*len(horizons) + np.arange(len(horizons)))*(maxcount+1) + counts
+        hist = np.bincount(flat.ravel(), minlength=n*len(horizons)*(maxcount+1))
+        out[lo:lo+n] = hist.reshape((n, len(horizons), maxcount+1)) / float(nsamples)
+    return out.reshape(outshape + (len(horizons), maxcount+1))
+
+
+def expectedcounts(pmf):
+    '''mean count from countdist output, counting the last bin as maxcount'''
+    return np.dot(pmf, np.arange(pmf.shape[-1]))
@@ -18,7 +18,7 @@ from keras.layers import Dense, GRU, LSTM
 from keras.layers.core import Dropout
 
 import sqrnn_objective as obj
-from kcallbacks import SaveValidWeights, TacticalRetreat, EarlyStopping
+from kcallbacks import CheckpointManager, TacticalRetreat, EarlyStopping
 
 
 class SQRNN(object):
@@ -54,7 +54,11 @@ class SQRNN(object):
         self.kmodel.summary()
 
         
-    def fit(self, xtrain, ytrain, iniscale, lr=.01, epochs=100, batch_size=1024, verbose=1):
+    def fit(self, xtrain, ytrain, iniscale, lr=.01, epochs=100, batch_size=1024, verbose=1, callbacks=None):
+        '''
+        callbacks are run after the default ones, e.g. kcallbacks.ASHA
+        returns the keras History of training
+        '''
         
         nobs, nseq, nvar = xtrain.shape
         self.compile(lr=lr, 
@@ -74,21 +78,22 @@ class SQRNN(object):
             print ('overall loss:', self.kmodel.evaluate(x=xtrain, y=ytrain, batch_size=batch_size, verbose=1))
         
         # callbacks
-        save_val = SaveValidWeights(self.weightsfname)
-        tact_ret = TacticalRetreat(self.weightsfname)
+        checkpoints = CheckpointManager(self.weightsfname)
+        tact_ret = TacticalRetreat(self.weightsfname, checkpoints=checkpoints)
         earlystop = EarlyStopping(patience=20)
         
         t0 = time.time()        
         if verbose>0:
             print ('doing training...')
             
-        self.kmodel.fit(xtrain, ytrain, validation_split = .1, shuffle = True,
-                        batch_size = batch_size,
-                        epochs = epochs, callbacks = [save_val, tact_ret, earlystop],
-                        verbose = 2)
+        history = self.kmodel.fit(xtrain, ytrain, validation_split = .1, shuffle = True,
+                                  batch_size = batch_size,
+                                  epochs = epochs, callbacks = [checkpoints, tact_ret, earlystop] + list(callbacks or []),
+                                  verbose = 2)
         
         if verbose>0:
             print ('training done in:', time.time()-t0)
+        return history
 
         
     def infer(self, x, verbose=1):
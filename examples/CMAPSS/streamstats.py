@@ -0,0 +1,157 @@
+import numpy as np
+
+
+class StreamingStats(object):
+    '''
+    one-pass statistics of data arriving in chunks, mergeable across chunks, shards and processes
+    update(m) takes m in the layout of utils.split
+        m[..., :4*neventtypes] holds (tse, tte, unc, pcs) of each event type, covariates follow
+        -1 marks timesteps before an observation starts
+    updatecov(cov) takes rows of covariates only, e.g. the raw table before scaling
+    per event type, at the last timestep of each observation
+        exposure = sum of tse + tte, events = sum of unc, tse = sum of tse
+    per covariate, over observed timesteps
+        count, mean, m2 (sum of squared deviations), min, max ignoring nans
+        and a uniform sample of rows (bottom-k random keys) for robust ranges
+    '''
+
+    def __init__(self, neventtypes=1, ncov=0, samplesize=1024, seed=None):
+        self.neventtypes, self.ncov, self.samplesize = neventtypes, ncov, samplesize
+        self.rng = np.random.RandomState(seed)
+        self.nobs = 0
+        self.exposure = np.zeros(neventtypes)
+        self.events = np.zeros(neventtypes)
+        self.tse = np.zeros(neventtypes)
+        self.nsteps = np.zeros(neventtypes)
+        self.uncsteps = np.zeros(neventtypes)
+        self.count = np.zeros(ncov)
+        self.mean = np.zeros(ncov)
+        self.m2 = np.zeros(ncov)
+        self.min = np.full(ncov, np.inf)
+        self.max = np.full(ncov, -np.inf)
+        self.samplekeys = np.empty(0)
+        self.sample = np.empty((0, ncov))
+
+    def update(self, m):
+        '''add observations m of shape (nobs, nseq, 4*neventtypes + ncov)'''
+        nev = self.neventtypes
+        m = np.asarray(m)
+        y = m[..., :4*nev].reshape(m.shape[:2] + (nev, 4))
+        observed = y[..., 0] != -1
+        yobs = np.where(observed[..., None], y, 0)
+
+        last = yobs[:, -1, :, :]
+        self.nobs += len(m)
+        self.exposure += np.sum(last[..., 0] + last[..., 1], axis=0)
+        self.events += np.sum(last[..., 2], axis=0)
+        self.tse += np.sum(last[..., 0], axis=0)
+        self.nsteps += np.sum(observed, axis=(0, 1))
+        self.uncsteps += np.sum(yobs[..., 2], axis=(0, 1))
+
+        # covariates of timesteps where the first event type is observed
+        self.updatecov(m[..., 4*nev:][observed[..., 0]])
+        return self
+
+    def updatecov(self, cov):
+        '''add rows of covariates cov of shape (nrows, ncov), nans are ignored'''
+        cov = np.asarray(cov, dtype=float)
+        if len(cov) == 0:
+            return self
+        valid = ~np.isnan(cov)
+        count = np.sum(valid, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = np.where(count > 0, np.nansum(cov, axis=0) / count, 0.)
+        m2 = np.nansum((cov - mean)**2, axis=0)
+        self.mergemoments(count, mean, m2)
+        self.min = np.fmin(self.min, np.nanmin(np.where(valid, cov, np.inf), axis=0))
+        self.max = np.fmax(self.max, np.nanmax(np.where(valid, cov, -np.inf), axis=0))
+        self.mergesample(self.rng.rand(len(cov)), cov)
+        return self
+
+    def mergemoments(self, count, mean, m2):
+        # pairwise update of Chan et al.
+        total = self.count + count
+        with np.errstate(invalid='ignore', divide='ignore'):
+            delta = mean - self.mean
+            self.mean = np.where(total > 0, self.mean + delta*count/total, 0.)
+            self.m2 = np.where(total > 0, self.m2 + m2 + delta**2*self.count*count/total, 0.)
+        self.count = total
+
+    def mergesample(self, keys, rows):
+        keys = np.concatenate([self.samplekeys, keys])
+        rows = np.concatenate([self.sample, rows])
+        if len(keys) > self.samplesize:
+            keep = np.argpartition(keys, self.samplesize)[:self.samplesize]
+            keys, rows = keys[keep], rows[keep]
+        self.samplekeys, self.sample = keys, rows
+
+    def merge(self, other):
+        '''add statistics of other into self, returns self'''
+        self.nobs += other.nobs
+        for name in ['exposure', 'events', 'tse', 'nsteps', 'uncsteps']:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        self.mergemoments(other.count, other.mean, other.m2)
+        self.min = np.fmin(self.min, other.min)
+        self.max = np.fmax(self.max, other.max)
+        self.mergesample(other.samplekeys, other.sample)
+        return self
+
+    def iniscale(self):
+        '''
+        per event type maximum likelihood scale if shape is 1, i.e. exposure / events
+        '''
+        return self.exposure / np.maximum(self.events, 1)
+
+    def meantse(self):
+        '''per event type mean tse at the last timestep'''
+        return self.tse / max(self.nobs, 1)
+
+    def censoring(self):
+        '''per event type fraction of observations censored at their last timestep'''
+        return 1. - self.events / max(self.nobs, 1)
+
+    def stepcensoring(self):
+        '''per event type fraction of observed timesteps whose next event is censored'''
+        return 1. - self.uncsteps / np.maximum(self.nsteps, 1)
+
+    def var(self):
+        return self.m2 / np.maximum(self.count, 1)
+
+    def covrange(self, q=0.):
+        '''
+        (low, high) of each covariate, exact (min, max) if q is 0
+        otherwise (q, 1-q) quantiles estimated from the sample
+        '''
+        if q == 0.:
+            return self.min, self.max
+        return np.nanquantile(self.sample, q, axis=0), np.nanquantile(self.sample, 1.-q, axis=0)
+
+    def dscaling(self, index, q=0.):
+        '''DataFrame of covariate (min, max) as in data/dscaling.pkl4'''
+        import pandas as pd
+        low, high = self.covrange(q)
+        return pd.DataFrame({'min': low, 'max': high}, index=index)
+
+    def save(self, fname):
+        arrs = {name: getattr(self, name) for name in
+                ['exposure', 'events', 'tse', 'nsteps', 'uncsteps', 'count', 'mean', 'm2', 'min', 'max',
+                 'samplekeys', 'sample']}
+        np.savez(fname, nobs=self.nobs, samplesize=self.samplesize, **arrs)
+
+    @classmethod
+    def load(cls, fname):
+        arrs = np.load(fname)
+        stats = cls(neventtypes=len(arrs['exposure']), ncov=len(arrs['count']), samplesize=int(arrs['samplesize']))
+        stats.nobs = int(arrs['nobs'])
+        for name in arrs.files:
+            if name not in ['nobs', 'samplesize']:
+                setattr(stats, name, arrs[name])
+        return stats
+
+
+def merge(statslist):
+    '''merge a list of StreamingStats into the first one'''
+    stats = statslist[0]
+    for other in statslist[1:]:
+        stats.merge(other)
+    return stats
@@ -0,0 +1,169 @@
+'''
+train a grid of MATRNN configurations concurrently and rank them by validation loss
+
+    python sweep.py --data mlocaltrain --d 1 2 --w 32 64 --lr 1e-4 1e-5 --winlen 78 --iswtte 0 1 --out sweep.csv
+
+x and y are split once into .npy files in shared memory (/dev/shm if there is one)
+which every worker memory-maps read only, windows are gathered on the fly from them
+jobs run in a process pool, most expensive first, cost taken as d * w^2 * winlen
+so that long jobs do not end up last (longest processing time first)
+with --eta, runs are stopped by asynchronous successive halving (kcallbacks.ASHA)
+and their process goes to the next configuration
+'''
+import os
+import time
+import gzip
+import shutil
+import pickle
+import argparse
+import itertools
+import tempfile
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+import utils
+import dataset
+import streamstats
+
+
+def getcost(config):
+    '''relative cost of a configuration, an LSTM step costs about w^2 per layer'''
+    return config['d'] * config['w']**2 * config['winlen']
+
+
+def getconfigs(ds, ws, lrs, winlens, iswttes):
+    '''grid of configurations, most expensive first'''
+    configs = [{'d': d, 'w': w, 'lr': lr, 'winlen': winlen, 'iswtte': bool(iswtte)}
+               for d, w, lr, winlen, iswtte in itertools.product(ds, ws, lrs, winlens, iswttes)]
+    for k, config in enumerate(configs):
+        config['jobid'] = 'sweep%03d%s' % (k, 'wtte' if config['iswtte'] else 'matrnn')
+    return sorted(configs, key=getcost, reverse=True)
+
+
+def toshared(path, x, y, chunksize=1024):
+    '''write x, y to .npy files in directory path chunk by chunk and return them memory-mapped read only'''
+    for name, a in [('x', x), ('y', y)]:
+        out = np.lib.format.open_memmap(os.path.join(path, name + '.npy'), mode='w+', dtype=a.dtype, shape=a.shape)
+        for lo in range(0, len(a), chunksize):
+            out[lo:lo+chunksize] = a[lo:lo+chunksize]
+        out.flush()
+        del out
+    return [np.load(os.path.join(path, name + '.npy'), mmap_mode='r') for name in ['x', 'y']]
+
+
+# set in workers by the pool initializer
+_shared = {}
+
+
+def initworker(xpath, ypath, iniscale, fitargs, threads, asha):
+    _shared.update(iniscale=iniscale, fitargs=fitargs, threads=threads, asha=asha)
+    _shared['x'] = np.load(xpath, mmap_mode='r')
+    _shared['y'] = np.load(ypath, mmap_mode='r')
+    _shared['neventtypes'] = _shared['y'].shape[2]
+
+
+def runjob(config):
+    '''fit one configuration, return its row of the results table'''
+    import tensorflow as tf
+    import keras.backend as K
+    import matrnn_fitter as fitter
+    from kcallbacks import ASHA, RungTable
+
+    K.clear_session()
+    threads = _shared['threads']
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                   inter_op_parallelism_threads=1)))
+    t0 = time.time()
+    model = fitter.MATRNN(modelspec_tuple=(config['d'], config['w']), jobid=config['jobid'],
+                          iswtte=config['iswtte'], neventtypes=_shared['neventtypes'])
+    callbacks = []
+    if _shared['asha'] is not None:
+        # runs are compared with runs of the same model type
+        tablefname, minepochs, eta = _shared['asha']
+        key = 'wtte' if config['iswtte'] else 'matrnn'
+        callbacks.append(ASHA(RungTable(tablefname), key, config['jobid'], minepochs=minepochs, eta=eta))
+    history = model.fit(_shared['x'], _shared['y'], iniscale=_shared['iniscale'], lr=config['lr'],
+                        winlen=config['winlen'], verbose=0, callbacks=callbacks, **_shared['fitargs'])
+    res = dict(config)
+    valloss = np.array(history.history.get('val_loss', [np.nan]), dtype=float)
+    res.update({'val_loss': np.nanmin(valloss) if np.any(np.isfinite(valloss)) else np.nan,
+                'bestepoch': int(np.nanargmin(valloss)) if np.any(np.isfinite(valloss)) else -1,
+                'epochs': len(history.epoch), 'seconds': time.time() - t0, 'cost': getcost(config),
+                'weightsfname': model.weightsfname,
+                'stoppedrung': callbacks[0].stopped_rung if len(callbacks) > 0 else None})
+    print ('done', config['jobid'], 'val_loss:', res['val_loss'], 'in', res['seconds'])
+    return res
+
+
+def sweep(x, y, configs, iniscale, nprocs=None, threads=1, epochs=100, batch_size=1024, shmdir=None,
+          eta=None, minepochs=1):
+    '''
+    fit configs on shared x, y in a pool of nprocs processes with threads tensorflow threads each
+    if eta, runs not in the best 1/eta at epochs minepochs * eta**k are stopped, see kcallbacks.ASHA
+    returns DataFrame of results ranked by best validation loss
+    '''
+    nprocs = max(1, multiprocessing.cpu_count() // threads) if nprocs is None else nprocs
+    if shmdir is None and os.path.isdir('/dev/shm'):
+        shmdir = '/dev/shm'
+    path = tempfile.mkdtemp(prefix='matrnnsweep', dir=shmdir)
+    try:
+        toshared(path, x, y)
+        fitargs = {'epochs': epochs, 'batch_size': batch_size}
+        asha = (os.path.join(path, 'rungs.jsonl'), minepochs, eta) if eta is not None else None
+        # fork before any tensorflow session exists in this process
+        pool = multiprocessing.get_context('fork').Pool(
+            nprocs, initializer=initworker,
+            initargs=(os.path.join(path, 'x.npy'), os.path.join(path, 'y.npy'), iniscale, fitargs, threads, asha))
+        # configs are in decreasing cost, chunksize 1 hands the next one to the first free worker
+        resl = list(pool.imap_unordered(runjob, configs, chunksize=1))
+        pool.close()
+        pool.join()
+    finally:
+        shutil.rmtree(path)
+
+    res = pd.DataFrame(resl).sort_values('val_loss', kind='mergesort').reset_index(drop=True)
+    res.insert(0, 'rank', np.arange(1, len(res)+1))
+    return res
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--data', default='mlocaltrain', help='dataset directory or .pkl of m')
+    parser.add_argument('--neventtypes', type=int, default=1)
+    parser.add_argument('--d', type=int, nargs='+', default=[2])
+    parser.add_argument('--w', type=int, nargs='+', default=[64])
+    parser.add_argument('--lr', type=float, nargs='+', default=[1e-5])
+    parser.add_argument('--winlen', type=int, nargs='+', default=[78])
+    parser.add_argument('--iswtte', type=int, nargs='+', default=[0], choices=[0, 1])
+    parser.add_argument('--epochs', type=int, default=100)
+    parser.add_argument('--batch_size', type=int, default=1024*16)
+    parser.add_argument('--nprocs', type=int, default=None)
+    parser.add_argument('--threads', type=int, default=1, help='tensorflow threads per process')
+    parser.add_argument('--eta', type=int, default=None, help='successive halving rate, none by default')
+    parser.add_argument('--minepochs', type=int, default=1, help='epochs before the first successive halving rung')
+    parser.add_argument('--out', default='sweep.csv')
+    args = parser.parse_args(args)
+
+    if os.path.isdir(args.data):
+        m = dataset.load(args.data)
+        stats = dataset.loadstats(args.data)
+    else:
+        m = pickle.load(gzip.open(args.data, 'rb'))
+        stats = streamstats.StreamingStats(neventtypes=args.neventtypes, ncov=m.shape[2]-4*args.neventtypes).update(m)
+    x, y = utils.split(m, args.neventtypes)
+    iniscale = stats.iniscale()
+    iniscale = iniscale[0] if len(iniscale) == 1 else iniscale
+    print ('x.shape:', x.shape, 'y.shape:', y.shape, 'iniscale:', iniscale)
+
+    configs = getconfigs(args.d, args.w, args.lr, args.winlen, args.iswtte)
+    print ('running', len(configs), 'configurations')
+    res = sweep(x, y, configs, iniscale, nprocs=args.nprocs, threads=args.threads,
+                epochs=args.epochs, batch_size=args.batch_size, eta=args.eta, minepochs=args.minepochs)
+    res.to_csv(args.out, index=False)
+    print (res.to_string())
+
+
+if __name__ == '__main__':
+    main()
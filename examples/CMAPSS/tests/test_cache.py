@@ -0,0 +1,48 @@
+import time
+
+import numpy as np
+
+import matrnn_distributional as dist
+from matrnn_cache import DistCache
+
+
+def test_scalar_arguments():
+    cache = DistCache()
+    q = cache.quantile('a', 5., .5, 10., 2.)
+    assert np.ndim(q) == 0
+    assert np.isclose(q, dist.quantile(5., .5, 10., 2.))
+    assert cache.quantile('a', 5., .5, 10., 2.) is q
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_arrays_are_read_only():
+    cache = DistCache()
+    pmf, cdf = cache.discretegrid('a', np.arange(3.), np.full(3, 20.), np.ones(3), 5)
+    assert not pmf.flags.writeable and not cdf.flags.writeable
+
+
+def test_keys_and_invalidation():
+    cache = DistCache()
+    elapsed, scale, shape = np.arange(4.), np.full(4, 20.), np.ones(4)
+    q5 = cache.quantile('a', elapsed, .5, scale, shape)
+    assert cache.quantile('a', elapsed, .9, scale, shape) is not q5
+    assert cache.quantile('b', elapsed, .5, scale, shape) is not q5
+    assert cache.quantile('a', elapsed, .5, scale, shape) is q5
+    cache.invalidate(version='new weights')
+    assert len(cache) == 0
+    assert cache.quantile('a', elapsed, .5, scale, shape) is not q5
+
+
+def test_hit_is_cheaper_than_computing():
+    rng = np.random.RandomState(0)
+    n = 1000000
+    elapsed, scale, shape = rng.randint(0, 100, n).astype(float), rng.uniform(5, 300, n), rng.uniform(.5, 5, n)
+    cache = DistCache()
+    t0 = time.time()
+    cache.logsurv('a', elapsed, 10., scale, shape)
+    miss = time.time() - t0
+    t0 = time.time()
+    for k in range(10):
+        cache.logsurv('a', elapsed, 10., scale, shape)
+    hit = (time.time() - t0) / 10
+    assert hit < miss / 100
@@ -0,0 +1,51 @@
+import numpy as np
+import pytest
+
+import dataset
+
+
+def test_parted_shards_index_like_numpy(tmpdir):
+    path = str(tmpdir.join('m'))
+    rng = np.random.RandomState(0)
+    m = rng.randn(10, 6, 7)
+    m[..., :4] = rng.randint(-1, 50, (10, 6, 4))
+    dataset.save(path, m, shardsize=4, parts=dataset.getparts(1, 3, covdtype=np.float64))
+    parted = dataset.load(path)
+    assert parted.dtype == np.float64
+    for key in [(Ellipsis, 0), (slice(2, 9), Ellipsis, 5), (slice(None), 3), (Ellipsis,), ([7, 1, 4], Ellipsis, 2),
+                (slice(1, 8), slice(None), slice(3, 6)), [-1, 2], (np.array([-3, 0, -10]), Ellipsis, 1), -2]:
+        assert np.array_equal(parted[key], m[key])
+    assert np.array_equal(parted.shards[0][..., 0], m[:4, :, 0])
+    for key in [10, -11, [3, 10], [-11]]:
+        with pytest.raises(IndexError):
+            parted[key]
+
+
+def test_lazy_split_ellipsis(tmpdir):
+    import utils
+    path = str(tmpdir.join('m'))
+    m = np.random.RandomState(1).randint(-1, 9, (9, 5, 6)).astype(float)
+    dataset.save(path, m, shardsize=2, parts=dataset.getparts(1, 2))
+    x, y = utils.split(dataset.load(path))
+    xm, ym = utils.split(m.copy())
+    assert np.array_equal(x[..., 0], xm[..., 0])
+    assert np.array_equal(y[..., 0, 1], ym[..., 0, 1])
+
+
+def test_sparse_indices_stay_exact(tmpdir):
+    import eventlog
+    rng = np.random.RandomState(2)
+    n = 500
+    ent, t, feat = rng.randint(0, 5, n), rng.randint(0, 8, n), rng.randint(0, 5000, n)
+    y, entities, _ = eventlog.densify(ent, t, np.zeros(n, dtype=int), end=7, nseq=8, start=0)
+    idx, val, _, _ = eventlog.sparsify(ent, t, feat, rng.rand(n), entities=entities, end=7, nseq=8, start=0,
+                                       features=np.arange(5000))
+    assert idx.dtype == np.int32 and idx.max() > 2048
+    nnz = idx.shape[-1]
+    cov = np.zeros((len(entities), 8, 2))
+    m = np.concatenate([y.reshape((len(entities), 8, 4)), cov, idx, val], axis=-1)
+    path = str(tmpdir.join('m'))
+    dataset.save(path, m, parts=dataset.getparts(1, 2, covdtype=np.float16, nnz=nnz))
+    stored = dataset.load(path)[:]
+    assert np.array_equal(stored[..., 6:6+nnz], idx)
+    assert np.allclose(stored[..., 6+nnz:], val, atol=1e-3)
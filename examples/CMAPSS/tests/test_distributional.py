@@ -0,0 +1,16 @@
+import numpy as np
+
+import matrnn_distributional as dist
+
+
+def test_scalars_in_float64():
+    out = dist.logsurv(5, 3, 10., 2.)
+    assert out.dtype == np.float64
+    assert np.isclose(out, -.39, rtol=1e-12)
+
+
+def test_float32_arrays_in_float32():
+    tse = np.arange(3, dtype=np.float32)
+    assert dist.logsurv(tse, 3, 10., 2.).dtype == np.float32
+    assert dist.logsurv(tse.astype(np.float16), 3, 10., 2.).dtype == np.float32
+    assert dist.logsurv(tse.astype(float), 3, 10., 2.).dtype == np.float64
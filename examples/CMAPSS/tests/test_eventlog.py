@@ -0,0 +1,15 @@
+import numpy as np
+
+import eventlog
+
+
+def test_window_carries_earlier_arrivals():
+    rng = np.random.RandomState(0)
+    n = 300
+    ent, t, ev = rng.randint(0, 20, n), rng.randint(0, 60, n), rng.randint(0, 3, n)
+    start = rng.randint(0, 40, 20)
+    full, entities, _ = eventlog.densify(ent, t, ev, end=59, nseq=60, start=start)
+    for nseq in [1, 7, 30]:
+        win, _, _ = eventlog.densify(ent, t, ev, end=59, nseq=nseq, start=start)
+        # tse and purchstatus as if the whole history were in the window, tte and unc are per window
+        assert np.array_equal(win[..., [0, 3]], full[:, 60-nseq:, :, [0, 3]])
@@ -0,0 +1,35 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('keras')
+from kcallbacks import CheckpointManager, peakrss
+
+
+def getstate(epoch):
+    return (epoch, [np.full(2, epoch)], [np.zeros(1)], .01)
+
+
+def test_fresh_run_over_existing_checkpoints(tmpdir):
+    ckptdir = str(tmpdir.join('weights.ckpt'))
+    old = CheckpointManager('weights.h5', keep=3, ckptdir=ckptdir)
+    os.makedirs(ckptdir)
+    for epoch in range(50, 53):
+        old.write(getstate(epoch))
+
+    new = CheckpointManager('weights.h5', keep=3, ckptdir=ckptdir)
+    new.on_train_begin()
+    assert new.lastepoch() == -1
+    for epoch in range(5):
+        new.write(getstate(epoch))
+    assert new.lastepoch() == 4
+    assert [os.path.basename(f) for f in new.ckptfnames()] == ['epoch000002.npz', 'epoch000003.npz', 'epoch000004.npz']
+    assert new.load(new.ckptfnames()[-1])[0] == 4
+    new.writes.put(None)
+    new.writer.join()
+
+
+def test_peakrss_in_bytes():
+    # any python process is well over a megabyte
+    assert peakrss() > 2**20
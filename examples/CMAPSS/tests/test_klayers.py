@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+from keras.models import Model
+from keras.layers import Input
+
+from klayers import SparseEmbedding
+from matrnn_numpy import NumpyMATRNN
+
+
+def test_sparse_embedding_matches_numpy():
+    rng = np.random.RandomState(0)
+    nnz, nsparse, nembed, ndense, w = 3, 50, 4, 2, 5
+    x = np.concatenate([rng.randn(6, 7, ndense), rng.randint(0, nsparse+1, (6, 7, nnz)), rng.randn(6, 7, nnz)],
+                       axis=-1).astype(np.float32)
+    # empty slots, and left padding
+    x[:, 3, ndense:ndense+nnz] = 0
+    x[:2, :2] = -1
+
+    xin = Input(shape=(None, x.shape[-1]))
+    layer = SparseEmbedding(nnz, nsparse, nembed)
+    kmodel = Model(inputs=xin, outputs=layer(xin))
+    embeddings = layer.get_weights()[0]
+
+    lstm = (np.zeros((ndense+nembed, 4*w)), np.zeros((w, 4*w)), np.zeros(4*w))
+    nmodel = NumpyMATRNN([lstm], (np.zeros((w, 2)), np.zeros(2)), 1., embeddings=embeddings, nnz=nnz)
+    assert np.allclose(kmodel.predict(x), nmodel.embed(x), atol=1e-5)
@@ -0,0 +1,18 @@
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+pytest.importorskip('keras')
+import keras.backend as K
+
+import matrnn_objective as obj
+
+
+def test_log1mexp_gradient_finite_at_tiny_a():
+    a = K.placeholder(ndim=1)
+    out = obj.log1mexp(a)
+    fn = K.function([a], [out] + K.gradients(K.sum(out), [a]))
+    avals = np.array([1e-30, 1e-11, 3e-8, 1e-3, .5, np.log(2.), 1., 20.], dtype=K.floatx())
+    val, grad = fn([avals])
+    assert np.all(np.isfinite(val)) and np.all(np.isfinite(grad))
+    assert np.allclose(val, np.log(-np.expm1(-avals.astype(float))), rtol=1e-5)
@@ -0,0 +1,20 @@
+import numpy as np
+
+import dataset
+import prep
+
+
+def test_sparse_slots_follow_units(tmpdir):
+    rng = np.random.RandomState(0)
+    rows = [[u, t] + list(rng.randn(24).round(3)) for u, T in [(1, 5), (2, 3)] for t in range(1, T+1)]
+    tmpdir.join('train.txt').write('\n'.join(' '.join(map(str, r)) for r in rows) + '\n')
+    tmpdir.join('ev.csv').write('unitdex,time,feature,value\n1,1,a,2\n1,5,b,1\n1,5,a,3\n2,3,c,1\n')
+    m, _ = prep.prep(['train.txt'], str(tmpdir.join('out')), True, datadir=str(tmpdir), nprocs=1,
+                     sparse=['ev.csv'])
+    m = m[:]
+    assert m.shape == (2, 6, 28 + 4)
+    # units end at the last step, slots are (index, index, value, value)
+    assert list(m[0, 1, 28:]) == [1, 0, 2, 0] and list(m[0, 5, 28:]) == [1, 2, 3, 1]
+    assert list(m[1, 5, 28:]) == [3, 0, 1, 0] and np.all(m[1, :3, 28:] == -1)
+    # slots are not covariates in the stats
+    assert dataset.loadstats(str(tmpdir.join('out'))).ncov == 24
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+
+from matrnn_serving import StateStore
+
+
+def test_ids_of_different_lengths():
+    store = StateStore(2, 3)
+    pos = store.lookup(['ab', 'cd'], create=True)
+    store.tse[pos, 0] = [1, 2]
+    pos = store.lookup(['abcdef'], create=True)
+    store.tse[pos, 0] = 3
+    assert len(store) == 3
+    assert list(store.ids) == ['ab', 'abcdef', 'cd']
+    assert list(store.tse[store.lookup(['ab', 'cd', 'abcdef']), 0]) == [1, 2, 3]
+
+
+def test_add_rejects_duplicates():
+    store = StateStore(1, 2)
+    with pytest.raises(ValueError):
+        store.add(np.array(['a', 'a']))
+    store.add(np.array(['a']))
+    with pytest.raises(ValueError):
+        store.add(np.array(['a']))
+
+
+def test_empty_store_ids(tmpdir):
+    store = StateStore(1, 2)
+    with pytest.raises(KeyError):
+        store.lookup([3])
+    store.lookup([5, 3], create=True)
+    assert store.ids.dtype.kind == 'i' and list(store.ids) == [3, 5]
+    fname = str(tmpdir.join('store.npz'))
+    StateStore(1, 2, iddtype=np.int64).save(fname)
+    assert StateStore.load(fname).ids.dtype == np.int64
@@ -1,22 +1,40 @@
 import numpy as np
 
 
-def split(m):
+def split(m, neventtypes=1, dtype=None):
     '''
     xtrain, ytrain = split(m)
+    m[..., :4*neventtypes] holds (tse, tte, unc, pcs) of each event type in turn, covariates follow
+    x keeps (tse, pcs) of each event type and the covariates, i.e. 
+        x[..., :] = (tse x neventtypes, pcs x neventtypes, covariates...)
+    y has shape (nobs, nseq, neventtypes, 4)
+    sparse covariates appended to m as (index x nnz, value x nnz), see data/eventlog.sparsify,
+        stay the last columns of x for MATRNN(..., sparse=(nnz, nsparse, nembed))
+        dtype float16 only holds indices up to 2048 exactly, float32 up to 2**24
+    m that is not a numpy array (e.g. dataset.ShardedArray) is split lazily chunk by chunk
+    x and y are cast to dtype if given, e.g. np.float32 as fed to keras
     '''
     nobs, nseq, nvar = m.shape
+    nev = neventtypes
+    if not isinstance(m, np.ndarray):
+        x = m.map(lambda chunk: split(chunk, nev, dtype)[0], (nobs, nseq, nvar-2*nev))
+        y = m.map(lambda chunk: split(chunk, nev, dtype)[1], (nobs, nseq, nev, 4))
+        return x, y
+    
     # (tse, tte, unc, pcs)
     # indices at [1,2] are tte, unc 
-    x = m[:, :, np.delete(np.arange(nvar), [1,2])]
+    tsedex, pcsdex = 4*np.arange(nev), 4*np.arange(nev) + 3
+    x = m[:, :, np.concatenate([tsedex, pcsdex, np.arange(4*nev, nvar)])]
     
-    y = m[:, :, :4]
+    y = m[:, :, :4*nev]
     # cap tte at 130 for cmapss datasets
     # http://www.hitachi-america.us/rd/about_us/bdl/docs/LSTM_RUL.PDF
     #y[:, :, 1] = np.minimum(y[:, :, 1], 130 * np.ones((nobs, nseq)))
-    y = y.reshape((nobs, nseq, 1, 4))
+    y = y.reshape((nobs, nseq, nev, 4))
     
     y[y<0] = 0
+    if dtype is not None:
+        x, y = x.astype(dtype, copy=False), y.astype(dtype, copy=False)
     return x, y
 
 
@@ -25,30 +43,59 @@ def windowed(xsingle, ysingle, winlen):
     split into windowed
     '''
     # xsingle.shape: nseq, ncov
-    # ysingle.shape: nseq, 1, 4
+    # ysingle.shape: nseq, neventtypes, 4
     nseq, ncov = xsingle.shape
     resl = [(xsingle[start:(start+winlen), ...].reshape((1, winlen, ncov)), 
-             ysingle[start:(start+winlen), ...].reshape((1, winlen, 1, 4)))
+             ysingle[start:(start+winlen), ...].reshape((1, winlen) + ysingle.shape[1:]))
             for start in range(0, nseq-winlen)]
     return resl
 
 
-def getlongver(xtrain, ytrain, winlen):
+def seqlengths(x):
     '''
-    window+concatenate
+    number of timesteps after the left padding of each observation
     '''
+    return np.sum(x[:, :, 0] > -1., axis=1)
 
-    resl = list(map(lambda i: windowed(xtrain[i, ...], ytrain[i, ...], winlen), np.arange(xtrain.shape[0])))
 
-    reslall = []
-    for resltemp in resl:
-        reslall += resltemp
+def windowview(a, winlen):
+    '''
+    zero-copy view of all windows along the time axis
+    a.shape: nobs, nseq, ... gives nobs, nseq-winlen+1, winlen, ...
+    '''
+    nobs, nseq = a.shape[:2]
+    shape = (nobs, max(0, nseq-winlen+1), winlen) + a.shape[2:]
+    strides = a.strides[:2] + a.strides[1:]
+    return np.lib.stride_tricks.as_strided(a, shape=shape, strides=strides, writeable=False)
+
 
-    xtrainlong = np.concatenate([reslall[i][0] for i in range(len(reslall))])
-    ytrainlong = np.concatenate([reslall[i][1] for i in range(len(reslall))])
-    
-    notmasked = xtrainlong[:, 0, 0] > -1.
-    xtrainlong = xtrainlong[notmasked, ...]
-    ytrainlong = ytrainlong[notmasked, ...]
-    
-    return xtrainlong, ytrainlong
\ No newline at end of file
+def windowindex(x, winlen):
+    '''
+    obsdex, startdex = windowindex(x, winlen)
+    windows that do not start with a masked value, in same order as getlongver
+    '''
+    nobs, nseq, ncov = x.shape
+    # windowed starts at range(0, nseq-winlen)
+    notmasked = x[:, :max(0, nseq-winlen), 0] > -1.
+    return np.nonzero(notmasked)
+
+
+def getwindows(x, y, obsdex, startdex, winlen):
+    '''
+    gather windows at (obsdex, startdex) into (len(obsdex), winlen, ...) copies
+    x and y that are not numpy arrays are only read at rows in obsdex
+    '''
+    if not isinstance(x, np.ndarray):
+        obsread, obsdex = np.unique(obsdex, return_inverse=True)
+        x, y = x[obsread], y[obsread]
+    xlong = windowview(x, winlen)[obsdex, startdex, ...]
+    ylong = windowview(y, winlen)[obsdex, startdex, ...]
+    return xlong, ylong
+
+
+def getlongver(xtrain, ytrain, winlen):
+    '''
+    window+concatenate
+    '''
+    obsdex, startdex = windowindex(xtrain, winlen)
+    return getwindows(xtrain, ytrain, obsdex, startdex, winlen)